@@ -3,17 +3,13 @@ import os
 import platform
 import time
 
-import imageio
 import numpy as np
 import torch
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
 from omegaconf import OmegaConf
-from scipy.spatial.transform import Rotation as R
+from torch.profiler import record_function
 from tqdm import tqdm
-import matplotlib.pyplot as plt
 
-from env.lib.raisim_env import RaisimWrapper
+from locodiff.replay_buffer import split_rollout
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +17,9 @@ log = logging.getLogger(__name__)
 class RaisimEnv:
 
     def __init__(self, cfg, seed=0):
+        # the compiled module is only needed once an environment is created
+        from env.lib.raisim_env import RaisimWrapper
+
         if platform.system() == "Darwin":
             os.environ["KMP_DUPLICATE_LIB_OK"] = "True"
 
@@ -88,17 +87,24 @@ class RaisimEnv:
         agent,
         n_inference_steps=None,
         real_time=False,
+        record=False,
+        profiler=None,
     ):
         """
-        Test the agent on the environment with the given goal function
+        Test the agent on the environment with the given goal function. With
+        record, the visited observations and predicted actions are returned
+        as episodes for the replay buffer. A StepProfiler is stepped once per
+        control step.
         """
         log.info("Starting trained model evaluation")
 
+        agent.latency.reset()
         total_rewards = np.zeros(self.num_envs, dtype=np.float32)
         total_dones = np.zeros(self.num_envs, dtype=np.int64)
         self.images = []
         skill = torch.zeros(self.num_envs, 2).to(self.device)
         skill[:, 0] = 1
+        episodes = []
 
         for _ in range(self.eval_n_times):
             self.env.reset()
@@ -111,6 +117,8 @@ class RaisimEnv:
             # now run the agent for n steps
             action = self.nominal_joint_pos
             action = np.tile(action, (self.num_envs, 1))
+            rollout = {"obs": [], "action": [], "vel_cmd": [], "reset": []}
+            reset = np.ones(self.num_envs, dtype=bool)
             for n in tqdm(range(self.eval_n_steps)):
                 start = time.time()
 
@@ -120,13 +128,22 @@ class RaisimEnv:
                 if n == self.eval_n_steps - 1:
                     total_dones += np.ones(done.shape, dtype="int64")
 
-                pred_action, pred_traj = agent.predict(
-                    {"obs": obs, "skill": skill, "vel_cmd": vel_cmd},
-                    new_sampling_steps=n_inference_steps,
-                )
+                with record_function("predict"):
+                    pred_action, pred_traj = agent.predict(
+                        {"obs": obs, "skill": skill, "vel_cmd": vel_cmd},
+                        new_sampling_steps=n_inference_steps,
+                    )
 
                 for i in range(self.T_action):
-                    obs, _, done = self.step(action)
+                    if record:
+                        rollout["obs"].append(obs.cpu().numpy().copy())
+                        rollout["action"].append(pred_action[:, i])
+                        rollout["vel_cmd"].append(vel_cmd.cpu().numpy().copy())
+                        rollout["reset"].append(reset)
+
+                    with record_function("env_step"):
+                        obs, _, done = self.step(action)
+                    reset = done
                     reward = self.compute_reward(obs, vel_cmd)
                     vel_cmd = self.get_vel_cmd()
                     total_rewards += reward
@@ -137,7 +154,13 @@ class RaisimEnv:
                         time.sleep(0.04 - delta)
                     start = time.time()
 
-        self.close()
+                if profiler is not None:
+                    profiler.step()
+
+            if record:
+                rollout = {k: np.stack(v, axis=1) for k, v in rollout.items()}
+                episodes += split_rollout(skill=skill.cpu().numpy(), **rollout)
+
         total_rewards /= self.eval_n_times * self.eval_n_steps
         avrg_reward = total_rewards.mean()
         std_reward = total_rewards.std()
@@ -148,9 +171,18 @@ class RaisimEnv:
             "std_reward": std_reward,
             "total_done": total_dones.mean(),
         }
+        if agent.latency.enabled:
+            log.info("Agent.predict latency\n" + agent.latency.table())
+            return_dict.update(agent.latency.summary())
+        if record:
+            return_dict["episodes"] = episodes
         return return_dict
     
     def plot_trajectory(self, pred_traj, goal):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+        from matplotlib.figure import Figure
+        from scipy.spatial.transform import Rotation as R
+
         # Calculate yaw angles from quaternions
         quat = pred_traj[0, :, 2:6]
         quat = np.roll(quat, shift=-1, axis=1)  # w, x, y, z -> x, y, z, w
@@ -0,0 +1,134 @@
+import logging
+import queue
+
+import hydra
+import torch.multiprocessing as mp
+from omegaconf import DictConfig, OmegaConf
+
+import locodiff.utils as utils
+
+log = logging.getLogger(__name__)
+
+
+def run_worker(cfg: dict, out_dir: str, requests: mp.Queue, results: mp.Queue):
+    """
+    Worker loop: load each weight snapshot into an inference-only agent and
+    roll it out in the simulator. The profiler window counts control steps
+    across all rollouts.
+    """
+    from env.raisim_env import RaisimEnv
+
+    cfg = OmegaConf.create(cfg)
+    agent = hydra.utils.instantiate(cfg.agents, dataset_fn=None)
+    # the snapshots already contain the EMA weights
+    agent.use_ema = False
+    env = RaisimEnv(cfg)
+    profiler = utils.StepProfiler(
+        out_dir, agent.device, name="sim_trace", **cfg.get("profiler", {})
+    )
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        step, model_state, scaler_state = request
+
+        agent.model.load_state_dict(model_state)
+        agent.scaler = utils.MinMaxScaler.from_state_dict(scaler_state, agent.device)
+        record = cfg.agents.replay_capacity > 0
+        results.put((step, env.simulate(agent, record=record, profiler=profiler)))
+
+    profiler.stop()
+    env.close()
+
+
+class SimWorker:
+    """
+    Runs RaisimEnv.simulate in a separate process so that the training loop
+    doesn't block on rollouts. A worker that dies mid-rollout is restarted,
+    unless it died before finishing any rollout.
+    """
+
+    def __init__(self, cfg: DictConfig, out_dir: str):
+        self.ctx = mp.get_context("spawn")
+        self.cfg = OmegaConf.to_container(cfg, resolve=True)
+        self.out_dir = out_dir
+        self.start()
+
+    def start(self):
+        self.requests = self.ctx.Queue()
+        self.results = self.ctx.Queue()
+        self.num_pending = 0
+        self.num_finished = 0
+        self.process = self.ctx.Process(
+            target=run_worker,
+            args=(self.cfg, self.out_dir, self.requests, self.results),
+            daemon=True,
+        )
+        self.process.start()
+
+    def check_alive(self):
+        """
+        Restart the worker if it died, dropping its pending rollouts
+        """
+        if self.process.is_alive():
+            return
+        exitcode = self.process.exitcode
+        if self.num_finished == 0:
+            raise RuntimeError(
+                f"Sim worker exited with code {exitcode} before finishing a rollout"
+            )
+        log.error(
+            f"Sim worker exited with code {exitcode}, dropping "
+            f"{self.num_pending} pending rollouts and restarting it"
+        )
+        self.start()
+
+    def submit(self, step: int, model_state: dict, scaler_state: dict):
+        """
+        Queue a rollout of the given weights, unless one is still running
+        """
+        self.check_alive()
+        if self.num_pending > 0:
+            log.warning(f"Simulation still running, skipping step {step}")
+            return
+        scaler_state = {k: v.cpu() for k, v in scaler_state.items()}
+        self.requests.put((step, model_state, scaler_state))
+        self.num_pending += 1
+
+    def poll(self) -> list:
+        """
+        Return any finished (step, results) pairs without blocking
+        """
+        finished = []
+        while self.num_pending > 0:
+            try:
+                finished.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+            self.num_pending -= 1
+            self.num_finished += 1
+        if self.num_pending > 0:
+            self.check_alive()
+        return finished
+
+    def close(self) -> list:
+        """
+        Wait for outstanding rollouts and stop the worker
+        """
+        finished = []
+        while self.num_pending > 0 and self.process.is_alive():
+            try:
+                finished.append(self.results.get(timeout=1))
+            except queue.Empty:
+                continue
+            self.num_pending -= 1
+        if self.num_pending > 0:
+            log.error(
+                f"Sim worker exited with code {self.process.exitcode}, dropping "
+                f"{self.num_pending} pending rollouts"
+            )
+
+        self.requests.put(None)
+        self.process.join()
+        return finished
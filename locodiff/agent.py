@@ -1,15 +1,21 @@
 import logging
 import math
 import os
+import random
+import time
 
 import hydra
+import numpy as np
 import torch
 import torch.nn as nn
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
+from torch.profiler import record_function
 from tqdm import tqdm
-import wandb
 
+import locodiff.checkpoint as checkpoint
 import locodiff.utils as utils
+from locodiff.dataloader import PrefetchLoader
+from locodiff.replay_buffer import MixedLoader, ReplayBuffer
 
 # A logger for this file
 log = logging.getLogger(__name__)
@@ -44,6 +50,19 @@ class Agent:
         weight_decay: float,
         cond_lambda: int,
         cond_mask_prob: float,
+        # defaults for the configs of runs trained before these options
+        full_eval_every_n_steps: int = 10000,
+        log_every_n_steps: int = 100,
+        num_val_samples: int = 4096,
+        num_val_sigmas: int = 8,
+        compile_model: bool = False,
+        fp16_checkpoint: bool = False,
+        checkpoint_every_n_steps: int = 10000,
+        num_prefetch: int = 2,
+        replay_capacity: int = 0,
+        replay_ratio: float = 0.25,
+        profiler: DictConfig = None,
+        latency_timers: bool = False,
     ):
         # model
         self.model = hydra.utils.instantiate(model).to(device)
@@ -55,6 +74,20 @@ class Agent:
         total_params = sum(p.numel() for p in self.model.get_params())
         log.info("Parameter count: {:e}".format(total_params))
 
+        # the dataloader drops the last batch, so training shapes are static
+        if compile_model:
+            # skips the data-dependent causal mask check that breaks the graph
+            self.model.inner_model.tgt_is_causal = True
+            self.loss_fn = utils.CompiledFunction(
+                self.model.loss, "loss", dynamic=False
+            )
+            self.denoiser = utils.CompiledFunction(
+                self.model, "denoiser", dynamic=False
+            )
+        else:
+            self.loss_fn = self.model.loss
+            self.denoiser = self.model
+
         # training
         optim_groups = self.model.inner_model.get_optim_groups(weight_decay)
         self.optimizer = hydra.utils.instantiate(optimization, optim_groups)
@@ -62,8 +95,24 @@ class Agent:
             lr_scheduler, optimizer=self.optimizer
         )
         self.steps = 0
+        self.best_val_loss = 1e10
+        self.val_loss = None
+        self.val_step = None
         self.max_train_steps = int(max_train_steps)
         self.eval_every_n_steps = eval_every_n_steps
+        self.full_eval_every_n_steps = full_eval_every_n_steps
+        self.log_every_n_steps = log_every_n_steps
+        self.num_val_samples = num_val_samples
+        self.num_val_sigmas = num_val_sigmas
+        self.num_prefetch = num_prefetch
+        self.profiler = profiler
+        self.fp16_checkpoint = fp16_checkpoint
+        self.checkpoint_every_n_steps = checkpoint_every_n_steps
+        self.checkpoint_writer = None
+        self.wandb_run_id = None
+        self.val_set = None
+        self.train_metrics = utils.MetricsAccumulator(device)
+        self.eval_metrics = utils.MetricsAccumulator(device)
 
         # ema
         self.ema_helper = utils.ExponentialMovingAverage(
@@ -80,6 +129,7 @@ class Agent:
         self.sigma_max = sigma_max
         self.cond_lambda = cond_lambda
         self.cond_mask_prob = cond_mask_prob
+        self.latency = utils.LatencyTimer(latency_timers, device)
 
         # env
         self.obs_dim = obs_dim
@@ -88,95 +138,335 @@ class Agent:
         self.num_envs = num_envs
         self.sim_every_n_steps = sim_every_n_steps
 
-        self.train_loader, self.test_loader, self.scaler = hydra.utils.instantiate(
-            dataset_fn
-        )
+        # data, loaded on first access so that inference doesn't pay for it.
+        # Without a dataset_fn, e.g. in simulation workers, the scaler is set
+        # from a checkpoint.
+        self.dataset_fn = dataset_fn
+        self.data_loaded = False
+        self._train_loader = None
+        self._test_loader = None
+        self._scaler = None
+
+        # online data from simulation rollouts, mixed into the training batches
+        self.replay_capacity = replay_capacity
+        self.replay_ratio = replay_ratio
+        self.replay_buffer = None
 
         # misc
         self.device = device
         self.env = None
+        self.sim_worker = None
         self.working_dir = None
         self.total_mse = None
 
+    @classmethod
+    def from_pretrained(cls, weights_path: str, cfg: DictConfig = None) -> "Agent":
+        """
+        Build an agent for inference from a training run directory, using the
+        stored config unless one is given, the model weights and the scaler.
+        No data is loaded unless the loaders are accessed.
+        """
+        start = time.perf_counter()
+        config_path = os.path.join(weights_path, ".hydra/config.yaml")
+        if cfg is None and os.path.exists(config_path):
+            cfg = OmegaConf.load(config_path)
+        elif cfg is None:
+            checkpoint_path = os.path.join(weights_path, checkpoint.CHECKPOINT_FILE)
+            cfg = OmegaConf.create(checkpoint.read_config(checkpoint_path))
+
+        agent = hydra.utils.instantiate(cfg.agents)
+        agent.load_pretrained_model(weights_path)
+        log.info(f"Cold start: {time.perf_counter() - start:.2f}s")
+        return agent
+
+    @property
+    def train_loader(self):
+        self.load_data()
+        return self._train_loader
+
+    @property
+    def test_loader(self):
+        self.load_data()
+        return self._test_loader
+
+    @property
+    def scaler(self):
+        if self._scaler is None:
+            self.load_data()
+        return self._scaler
+
+    @scaler.setter
+    def scaler(self, scaler):
+        self._scaler = scaler
+
+    @property
+    def prescaled(self):
+        return getattr(self.train_loader, "prescaled", False)
+
+    def load_data(self):
+        """
+        Build the dataloaders, and the scaler unless one was loaded already
+        """
+        if self.data_loaded or self.dataset_fn is None:
+            return
+        self.data_loaded = True
+
+        start = time.perf_counter()
+        # a loaded scaler, e.g. from a checkpoint, is also used for prescaling
+        train_loader, test_loader, self._scaler = hydra.utils.instantiate(
+            self.dataset_fn, scaler=self._scaler
+        )
+
+        if self.replay_capacity > 0:
+            self.replay_buffer = ReplayBuffer(
+                self.replay_capacity,
+                self.T_cond,
+                self.T,
+                self.device,
+                seed=torch.initial_seed(),
+            )
+            train_loader = MixedLoader(
+                train_loader, self.replay_buffer, self.replay_ratio, self._scaler
+            )
+        self._train_loader, self._test_loader = train_loader, test_loader
+        log.info(f"Loaded data in {time.perf_counter() - start:.2f}s")
+
     def train_agent(self):
         """
         Main training loop
         """
-        best_test_mse = 1e10
-        generator = iter(self.train_loader)
+        import wandb
+
+        if wandb.run is not None:
+            self.wandb_run_id = wandb.run.id
+        self.checkpoint_writer = checkpoint.CheckpointWriter()
+        if self.steps > 0:
+            # continue the data order of the resumed run. Only the vectorized
+            # loader can seek, so only it resumes exactly, and only without
+            # replay data, which is not part of the training state.
+            if hasattr(self.train_loader, "seek"):
+                self.train_loader.seek(self.steps)
+            else:
+                log.warning("The train loader can't seek, the data order restarts")
+            if self.replay_buffer is not None:
+                log.warning("The replay buffer starts empty")
+
+        if self.num_prefetch > 0:
+            generator = PrefetchLoader(
+                self.train_loader, self.device, self.num_prefetch
+            )
+        else:
+            generator = iter(self.train_loader)
+        last_log_time = time.perf_counter()
+        profiler = utils.StepProfiler(
+            self.working_dir,
+            self.device,
+            current_step=self.steps,
+            **(self.profiler or {}),
+        )
 
         for step in tqdm(
-            range(self.max_train_steps), position=0, leave=True, dynamic_ncols=True
+            range(self.steps, self.max_train_steps),
+            position=0,
+            leave=True,
+            dynamic_ncols=True,
         ):
-            # evaluate
+            # validate
             if not self.steps % self.eval_every_n_steps:
-                log_info = {
-                    "total_mse": [],
-                    "first_mse": [],
-                    "last_mse": [],
-                    "action_mse": [],
-                }
+                self.validate_and_store()
+
+            # evaluate with the full sampler
+            if not self.steps % self.full_eval_every_n_steps:
+                keys = ["total_mse", "first_mse", "last_mse", "action_mse"]
                 for batch in tqdm(
                     self.test_loader, desc="Evaluating", position=0, leave=True
                 ):
                     info = self.evaluate(batch)
-                    for key in log_info:
-                        log_info[key].append(info[key])
-                for key in log_info:
-                    log_info[key] = sum(log_info[key]) / len(log_info[key])
-                if log_info["total_mse"] < best_test_mse:
-                    best_test_mse = log_info["total_mse"]
-                    self.store_model_weights(self.working_dir)
-                    log.info("New best test loss. Stored weights have been updated!")
-                log_info["lr"] = self.optimizer.param_groups[0]["lr"]
-
-                wandb.log({k: v for k, v in log_info.items()}, step=self.steps)
+                    self.eval_metrics.add({k: info[k] for k in keys})
+                wandb.log(self.eval_metrics.flush(), step=self.steps)
 
             # train
-            try:
-                batch_loss = self.train_step(next(generator))
-            except StopIteration:
-                # restart the generator if the previous generator is exhausted.
-                generator = iter(self.train_loader)
-                batch_loss = self.train_step(next(generator))
-            if not self.steps % 100:
-                wandb.log({"loss": batch_loss}, step=self.steps)
+            with record_function("data"):
+                try:
+                    batch = next(generator)
+                except StopIteration:
+                    # restart the generator if the previous generator is exhausted.
+                    generator = iter(self.train_loader)
+                    batch = next(generator)
+            batch_loss = self.train_step(batch)
+            self.train_metrics.add({"loss": batch_loss})
+            if not self.steps % self.log_every_n_steps:
+                log_info = self.train_metrics.flush()
+                log_info["steps_per_sec"] = self.log_every_n_steps / (
+                    time.perf_counter() - last_log_time
+                )
+                if self.num_prefetch > 0:
+                    log_info.update(generator.get_metrics())
+                wandb.log(log_info, step=self.steps)
+                last_log_time = time.perf_counter()
 
             # simulate
             if not self.steps % self.sim_every_n_steps:
-                results = self.env.simulate(self)
-                wandb.log(results, step=self.steps)
-
+                with record_function("simulate"):
+                    if self.sim_worker is not None:
+                        self.sim_worker.submit(
+                            self.steps,
+                            self.get_ema_state_dict(),
+                            self.scaler.state_dict(),
+                        )
+                    elif self.env is not None:
+                        results = self.env.simulate(
+                            self, record=self.replay_buffer is not None
+                        )
+                        self.add_rollouts(results)
+                        wandb.log(results, step=self.steps)
+            if self.sim_worker is not None:
+                self.log_sim_results(self.sim_worker.poll())
+
+            # checkpoint at the end of the step, so a resumed run repeats
+            # nothing that consumes random numbers
+            if (
+                self.checkpoint_every_n_steps > 0
+                and not self.steps % self.checkpoint_every_n_steps
+            ):
+                self.save_training_state(self.working_dir)
+            profiler.step()
+
+        profiler.stop()
+        if self.num_prefetch > 0:
+            generator.close()
+        self.validate_and_store()
         self.store_model_weights(self.working_dir)
+        self.checkpoint_writer.close()
+        self.checkpoint_writer = None
+        if self.sim_worker is not None:
+            self.log_sim_results(self.sim_worker.close())
         log.info("Training done!")
 
+    def validate_and_store(self):
+        """
+        Validate, store the weights if they improved and log the loss. A step
+        that was validated already, e.g. before the run was resumed, is
+        skipped.
+        """
+        import wandb
+
+        if self.val_step == self.steps:
+            return
+        self.val_loss = self.validate()
+        self.val_step = self.steps
+        if self.val_loss < self.best_val_loss:
+            self.best_val_loss = self.val_loss
+            self.store_model_weights(self.working_dir)
+            log.info("New best validation loss. Stored weights have been updated!")
+        log_info = {"val_loss": self.val_loss}
+        log_info["lr"] = self.optimizer.param_groups[0]["lr"]
+
+        wandb.log(log_info, step=self.steps)
+
+    def log_sim_results(self, results: list):
+        """
+        Log results from the simulation worker against the step they were
+        submitted at
+        """
+        import wandb
+
+        for sim_step, result in results:
+            self.add_rollouts(result)
+            wandb.log({**result, "sim_step": sim_step}, step=self.steps)
+
+    def add_rollouts(self, results: dict):
+        """
+        Move recorded rollout episodes from the simulation results into the
+        replay buffer
+        """
+        episodes = results.pop("episodes", None)
+        if episodes is None or self.replay_buffer is None:
+            return
+        for episode in episodes:
+            self.replay_buffer.add_episode(**episode)
+        results["replay_episodes"] = self.replay_buffer.num_episodes
+        results["replay_windows"] = len(self.replay_buffer)
+
     def train_step(self, batch: dict):
-        data_dict = self.process_batch(batch)
+        with record_function("process_batch"):
+            data_dict = self.process_batch(batch, self.prescaled)
 
         self.model.train()
         self.model.training = True
 
-        noise = torch.randn_like(data_dict["action"])
-        sigma = self.make_sample_density(len(noise))
-        loss = self.model.loss(noise, sigma, data_dict)
-
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
-        self.lr_scheduler.step()
+        with record_function("forward"):
+            noise = torch.randn_like(data_dict["action"])
+            sigma = self.make_sample_density(len(noise))
+            loss = self.loss_fn(noise, sigma, data_dict)
+
+        with record_function("backward"):
+            self.optimizer.zero_grad()
+            loss.backward()
+        with record_function("optimizer"):
+            self.optimizer.step()
+            self.lr_scheduler.step()
         self.steps += 1
 
         # update the ema model
         if self.steps % self.update_ema_every_n_steps == 0:
-            self.ema_helper.update(self.model.parameters())
-        return loss.item()
+            with record_function("ema"):
+                self.ema_helper.update(self.model.parameters())
+        return loss.detach()
+
+    @torch.no_grad()
+    @record_function("validate")
+    def validate(self) -> float:
+        """
+        Calculate the denoising loss on a fixed subset of the test set, using a
+        fixed grid of sigmas and fixed noise so results are comparable across steps
+        """
+        if self.val_set is None:
+            self.val_set = self.build_val_set()
+
+        if self.use_ema:
+            self.ema_helper.store(self.model.parameters())
+            self.ema_helper.copy_to(self.model.parameters())
+        self.model.eval()
+        self.model.training = False
+
+        # the uncompiled loss, as no_grad and the ragged last slice would each
+        # need their own compiled graph
+        val_loss = get_val_loss(
+            self.model.loss, self.val_set, self.test_loader.batch_size
+        ).item()
+
+        # restore the previous model parameters
+        if self.use_ema:
+            self.ema_helper.restore(self.model.parameters())
+
+        return val_loss
+
+    @torch.no_grad()
+    def build_val_set(self):
+        """
+        Cache the first num_val_samples test windows along with the noise and
+        sigma grid used by validate
+        """
+        val_set = make_val_set(
+            self.test_loader,
+            lambda batch: self.process_batch(batch, self.prescaled),
+            self.num_val_samples,
+            self.num_val_sigmas,
+            self.sigma_min,
+            self.sigma_max,
+            self.device,
+        )
+        log.info(f"Cached {len(val_set[0]['action'])} validation windows")
+        return val_set
 
     @torch.no_grad()
+    @record_function("evaluate")
     def evaluate(self, batch: dict) -> dict:
         """
         Calculate model prediction error
         """
-        data_dict = self.process_batch(batch)
+        data_dict = self.process_batch(batch, self.prescaled)
 
         if self.use_ema:
             self.ema_helper.store(self.model.parameters())
@@ -192,16 +482,16 @@ class Agent:
         x_0 = self.sample_ddim(noise, sigmas, data_dict, predict=False)
 
         mse = nn.functional.mse_loss(x_0, data_dict["action"], reduction="none")
-        total_mse = mse.mean().item()
+        total_mse = mse.mean()
         self.total_mse = total_mse
 
         # state and action mse
-        state_mse = mse[:, :, : self.pred_obs_dim].mean().item()
-        action_mse = mse[:, :, self.pred_obs_dim :].mean().item()
+        state_mse = mse[:, :, : self.pred_obs_dim].mean()
+        action_mse = mse[:, :, self.pred_obs_dim :].mean()
 
         # mse of the first and last timestep
-        first_mse = mse[:, 0, :].mean().item()
-        last_mse = mse[:, -1, :].mean().item()
+        first_mse = mse[:, 0, :].mean()
+        last_mse = mse[:, -1, :].mean()
         timestep_mse = mse.mean(dim=(0, 2))
 
         prediction = self.scaler.inverse_scale_output(x_0)[..., : self.pred_obs_dim]
@@ -231,8 +521,11 @@ class Agent:
         """
         Inference method
         """
+        self.latency.start()
         batch["obs"] = self.stack_context(batch["obs"])
+        self.latency.lap("stack_context")
         data_dict = self.process_batch(batch)
+        self.latency.lap("process_batch")
 
         if new_sampling_steps is not None:
             n_sampling_steps = new_sampling_steps
@@ -253,15 +546,20 @@ class Agent:
         noise = torch.randn((self.num_envs, self.T, sa_dim), device=self.device)
         noise *= self.sigma_max
 
+        self.latency.lap("setup")
         x_0 = self.sample_ddim(noise, sigmas, data_dict, predict=True)
 
         # get the action for the current timestep
         x_0 = self.scaler.clip(x_0)
-        pred_traj = self.scaler.inverse_scale_output(x_0).cpu().numpy()
+        pred_traj = self.scaler.inverse_scale_output(x_0)
+        self.latency.lap("clip_scale")
+        pred_traj = pred_traj.cpu().numpy()
+        self.latency.lap("host_transfer")
         pred_action = pred_traj[:, : self.T_action, self.pred_obs_dim :].copy()
 
         if self.use_ema:
             self.ema_helper.restore(self.model.parameters())
+        self.latency.stop()
 
         return pred_action, pred_traj
 
@@ -289,10 +587,32 @@ class Agent:
             if predict:
                 denoised = self.cfg_forward(x_t, sigmas[i] * s_in, data_dict)
             else:
-                denoised = self.model(x_t, sigmas[i] * s_in, data_dict)
+                denoised = self.denoiser(x_t, sigmas[i] * s_in, data_dict)
             t, t_next = t_fn(sigmas[i]), t_fn(sigmas[i + 1])
             h = t_next - t
             x_t = (sigma_fn(t_next) / sigma_fn(t)) * x_t - (-h).expm1() * denoised
+            if predict:
+                self.latency.lap("denoise_step")
+
+        return x_t
+
+    @torch.no_grad()
+    def sample_euler(
+        self, noise: torch.Tensor, sigmas: torch.Tensor, data_dict: dict, predict: bool
+    ):
+        """
+        Perform inference using the Euler sampler of Karras et al. 2022
+        """
+        x_t = noise
+        s_in = x_t.new_ones([x_t.shape[0]])
+
+        for i in range(len(sigmas) - 1):
+            if predict:
+                denoised = self.cfg_forward(x_t, sigmas[i] * s_in, data_dict)
+            else:
+                denoised = self.denoiser(x_t, sigmas[i] * s_in, data_dict)
+            d = (x_t - denoised) / sigmas[i]
+            x_t = x_t + d * (sigmas[i + 1] - sigmas[i])
 
         return x_t
 
@@ -300,62 +620,148 @@ class Agent:
         """
         Classifier-free guidance sample
         """
-        out = self.model(x_t, sigma, data_dict)
+        out = self.denoiser(x_t, sigma, data_dict)
 
         if self.cond_mask_prob > 0:
-            out_uncond = self.model(x_t, sigma, data_dict, uncond=True)
+            out_uncond = self.denoiser(x_t, sigma, data_dict, uncond=True)
             out = out_uncond + self.cond_lambda * (out - out_uncond)
 
         return out
 
     def load_pretrained_model(self, weights_path: str, **kwargs) -> None:
-        self.model.load_state_dict(
-            torch.load(
+        checkpoint_path = os.path.join(weights_path, checkpoint.CHECKPOINT_FILE)
+        if os.path.exists(checkpoint_path):
+            state = checkpoint.load_checkpoint(checkpoint_path)
+            model_state, scaler_state = state["ema"], state["scaler"]
+        else:
+            # runs from before the single file checkpoints
+            model_state = torch.load(
                 os.path.join(weights_path, "model_state_dict.pth"),
                 map_location=self.device,
-            ),
-            strict=False,
-        )
+            )
+            scaler_state = torch.load(
+                os.path.join(weights_path, "scaler.pth"), map_location=self.device
+            )
 
-        # Load scaler attributes
-        scaler_state = torch.load(
-            os.path.join(weights_path, "scaler.pth"), map_location=self.device
-        )
-        self.scaler.x_max = scaler_state["x_max"]
-        self.scaler.x_min = scaler_state["x_min"]
-        self.scaler.y_max = scaler_state["y_max"]
-        self.scaler.y_min = scaler_state["y_min"]
-        self.scaler.cmd_max = scaler_state["cmd_max"]
-        self.scaler.cmd_min = scaler_state["cmd_min"]
+        self.model.load_state_dict(model_state, strict=False)
+        self.scaler = utils.MinMaxScaler.from_state_dict(scaler_state, self.device)
 
         log.info("Loaded pre-trained model parameters and scaler")
 
     def store_model_weights(self, store_path: str) -> None:
+        """
+        Write the EMA and raw weights, the scaler and the run config to a
+        single checkpoint file. During training the file is written on the
+        checkpoint writer thread.
+        """
+        ema_state = self.get_ema_state_dict() if self.use_ema else None
+        model_state = checkpoint.snapshot(self.model.state_dict())
+        self.write(
+            checkpoint.save_checkpoint,
+            os.path.join(store_path, checkpoint.CHECKPOINT_FILE),
+            ema_state,
+            model_state,
+            self.scaler.state_dict(),
+            checkpoint.load_run_config(store_path),
+            half=self.fp16_checkpoint,
+        )
+
+    def save_training_state(self, store_path: str) -> None:
+        """
+        Snapshot everything needed to resume training and write it in the
+        background
+        """
+        state = checkpoint.snapshot(self.get_training_state())
+        path = os.path.join(store_path, checkpoint.TRAINING_STATE_FILE)
+        self.write(checkpoint.save_training_state, path, state)
+
+    def write(self, fn, *args, **kwargs):
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.submit(fn, *args, **kwargs)
+        else:
+            fn(*args, **kwargs)
+
+    def get_training_state(self) -> dict:
+        """
+        Model, optimizer, scheduler and EMA state, counters, RNG states and the
+        position of the data loaders. The tensors are not copied.
+        """
+        rng = {
+            "torch": torch.get_rng_state(),
+            "numpy": np.random.get_state(),
+            "python": random.getstate(),
+        }
+        if torch.cuda.is_available():
+            rng["cuda"] = torch.cuda.get_rng_state_all()
+
+        state = {
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "lr_scheduler": self.lr_scheduler.state_dict(),
+            "ema": self.ema_helper.state_dict(),
+            "scaler": self.scaler.state_dict(),
+            "steps": self.steps,
+            "best_val_loss": self.best_val_loss,
+            "val_loss": self.val_loss,
+            "val_step": self.val_step,
+            "train_metrics": self.train_metrics.state_dict(),
+            "rng": rng,
+            "wandb_run_id": self.wandb_run_id,
+        }
+        # the train loader position follows from the steps
+        if hasattr(self.test_loader, "state_dict"):
+            state["test_loader"] = self.test_loader.state_dict()
+        return state
+
+    def load_training_state(self, state: dict) -> None:
+        """
+        Restore a state from get_training_state, so that train_agent continues
+        where the saved run stopped
+        """
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.lr_scheduler.load_state_dict(state["lr_scheduler"])
+        ema_state = dict(state["ema"])
+        ema_state["shadow_params"] = [
+            p.to(self.device) for p in ema_state["shadow_params"]
+        ]
+        self.ema_helper.load_state_dict(ema_state)
+        self.scaler = utils.MinMaxScaler.from_state_dict(state["scaler"], self.device)
+        self.steps = state["steps"]
+        self.best_val_loss = state["best_val_loss"]
+        self.val_loss = state.get("val_loss")
+        self.val_step = state.get("val_step")
+        self.train_metrics.load_state_dict(state["train_metrics"])
+        self.wandb_run_id = state["wandb_run_id"]
+
+        # the validation windows come from the first pass over the test
+        # loader, so they are drawn before its position is restored
+        self.val_set = self.build_val_set()
+        if "test_loader" in state:
+            self.test_loader.load_state_dict(state["test_loader"])
+
+        rng = state["rng"]
+        torch.set_rng_state(rng["torch"])
+        np.random.set_state(rng["numpy"])
+        random.setstate(rng["python"])
+        if "cuda" in rng and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng["cuda"])
+        log.info(f"Resumed training at step {self.steps}")
+
+    def get_ema_state_dict(self) -> dict:
+        """
+        CPU copy of the model weights used for inference
+        """
         if self.use_ema:
             self.ema_helper.store(self.model.parameters())
             self.ema_helper.copy_to(self.model.parameters())
-        torch.save(
-            self.model.state_dict(), os.path.join(store_path, "model_state_dict.pth")
-        )
+        state_dict = {
+            k: v.detach().to("cpu", copy=True)
+            for k, v in self.model.state_dict().items()
+        }
         if self.use_ema:
             self.ema_helper.restore(self.model.parameters())
-        torch.save(
-            self.model.state_dict(),
-            os.path.join(store_path, "non_ema_model_state_dict.pth"),
-        )
-
-        # Save scaler attributes
-        torch.save(
-            {
-                "x_max": self.scaler.x_max,
-                "x_min": self.scaler.x_min,
-                "y_max": self.scaler.y_max,
-                "y_min": self.scaler.y_min,
-                "cmd_max": self.scaler.cmd_max,
-                "cmd_min": self.scaler.cmd_min,
-            },
-            os.path.join(store_path, "scaler.pth"),
-        )
+        return state_dict
 
     @torch.no_grad()
     def make_sample_density(self, size):
@@ -377,30 +783,12 @@ class Agent:
         return density
 
     @torch.no_grad()
-    def process_batch(self, batch: dict) -> dict:
+    def process_batch(self, batch: dict, prescaled: bool = False) -> dict:
+        if prescaled:
+            # the loader already scaled and sliced the batch on the device
+            return batch
         batch = self.dict_to_device(batch)
-
-        raw_obs = batch["obs"]
-        raw_action = batch.get("action", None)
-        vel_cmd = batch["vel_cmd"]
-        skill = batch["skill"]
-
-        obs = self.scaler.scale_input(raw_obs[:, : self.T_cond])
-
-        if raw_action is None:
-            action = None
-        else:
-            action = torch.cat([raw_obs[..., : self.pred_obs_dim], raw_action], dim=-1)
-            action = self.scaler.scale_output(action[:, self.T_cond - 1 :])
-
-        processed_batch = {
-            "obs": obs,
-            "action": action,
-            "vel_cmd": vel_cmd,
-            "skill": skill,
-        }
-
-        return processed_batch
+        return scale_batch(batch, self.scaler, self.T_cond, self.pred_obs_dim)
 
     def dict_to_device(self, batch):
         return {k: v.clone().to(self.device) for k, v in batch.items()}
@@ -466,3 +854,88 @@ class Agent:
         returns = returns.repeat(1, self.T_cond).unsqueeze(-1)
 
         return returns
+
+
+# ----------------------------------------------
+# Helpers shared with locodiff.ensemble.Ensemble
+# ----------------------------------------------
+
+
+def scale_batch(batch: dict, scaler, T_cond: int, pred_obs_dim: int) -> dict:
+    """
+    Scale and slice a batch on the device into model inputs, where the action
+    is None for inference batches
+    """
+    raw_obs = batch["obs"]
+    raw_action = batch.get("action", None)
+
+    obs = scaler.scale_input(raw_obs[:, :T_cond])
+
+    if raw_action is None:
+        action = None
+    else:
+        action = torch.cat([raw_obs[..., :pred_obs_dim], raw_action], dim=-1)
+        action = scaler.scale_output(action[:, T_cond - 1 :])
+
+    return {
+        "obs": obs,
+        "action": action,
+        "vel_cmd": batch["vel_cmd"],
+        "skill": batch["skill"],
+    }
+
+
+@torch.no_grad()
+def make_val_set(
+    test_loader,
+    process_batch,
+    num_val_samples: int,
+    num_val_sigmas: int,
+    sigma_min: float,
+    sigma_max: float,
+    device: str,
+):
+    """
+    The first num_val_samples processed test windows with fixed noise and a
+    fixed sigma grid, so the validation loss only depends on the weights
+    """
+    batches = []
+    num_samples = 0
+    for batch in test_loader:
+        batches.append(process_batch(batch))
+        num_samples += len(batches[-1]["action"])
+        if num_samples >= num_val_samples:
+            break
+    data_dict = {
+        k: torch.cat([b[k] for b in batches])[:num_val_samples] for k in batches[0]
+    }
+
+    generator = torch.Generator(device=device).manual_seed(0)
+    sigmas = utils.get_sigmas_exponential(num_val_sigmas, sigma_min, sigma_max, device)
+    sigmas = sigmas[:-1]
+    noise = torch.randn(
+        (len(sigmas),) + data_dict["action"].shape,
+        generator=generator,
+        device=device,
+    )
+    return data_dict, noise, sigmas
+
+
+@torch.no_grad()
+def get_val_loss(loss_fn, val_set, batch_size: int) -> torch.Tensor:
+    """
+    Mean of loss_fn(noise, sigma, data_dict) over a validation set from
+    make_val_set, in batches. The loss may have a leading member dim.
+    """
+    data_dict, noise, sigmas = val_set
+    num_samples = len(data_dict["action"])
+
+    total_loss = 0.0
+    for i, sigma in enumerate(sigmas):
+        for start in range(0, num_samples, batch_size):
+            end = min(start + batch_size, num_samples)
+            batch = {k: v[start:end] for k, v in data_dict.items()}
+            sigma_in = sigma.expand(end - start)
+            loss = loss_fn(noise[i, start:end], sigma_in, batch)
+            total_loss = total_loss + loss * (end - start)
+    return total_loss / (len(sigmas) * num_samples)
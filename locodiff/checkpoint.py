@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import queue
+import threading
+
+import torch
+from omegaconf import OmegaConf
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+CHECKPOINT_FILE = "checkpoint.safetensors"
+TRAINING_STATE_FILE = "training_state.pt"
+FORMAT_VERSION = "1"
+
+log = logging.getLogger(__name__)
+
+
+def save_checkpoint(
+    path: str,
+    ema_state: dict,
+    model_state: dict,
+    scaler_state: dict,
+    config: dict = None,
+    half: bool = False,
+):
+    """
+    Write the EMA and raw model weights, the scaler statistics and the run
+    config to a single safetensors file. Without EMA, ema_state is None and
+    the raw weights are used for inference. With half, the inference weights
+    are stored in fp16.
+    """
+    if half:
+        inference_state = ema_state if ema_state is not None else model_state
+        inference_state = {
+            k: v.half() if v.is_floating_point() else v
+            for k, v in inference_state.items()
+        }
+        if ema_state is not None:
+            ema_state = inference_state
+        else:
+            model_state = inference_state
+
+    tensors = {}
+    if ema_state is not None:
+        for k, v in ema_state.items():
+            tensors["ema." + k] = v
+    for k, v in model_state.items():
+        tensors["model." + k] = v
+    for k, v in scaler_state.items():
+        tensors["scaler." + k] = v
+    tensors = {k: v.detach().cpu().contiguous() for k, v in tensors.items()}
+
+    metadata = {
+        "format_version": FORMAT_VERSION,
+        "has_ema": str(ema_state is not None),
+        "config": json.dumps(config),
+    }
+
+    # write to a temporary file first so a crash never leaves a partial file
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    save_file(tensors, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str, device: str = "cpu") -> dict:
+    """
+    Memory-map a checkpoint written by save_checkpoint. On the CPU the tensors
+    are views of the file, so nothing is copied until they are used.
+    """
+    state = {"ema": {}, "model": {}, "scaler": {}}
+    with safe_open(path, framework="pt", device=device) as f:
+        metadata = f.metadata()
+        for key in f.keys():
+            group, name = key.split(".", 1)
+            state[group][name] = f.get_tensor(key)
+
+    if metadata["has_ema"] != "True":
+        state["ema"] = state["model"]
+    state["config"] = json.loads(metadata["config"])
+    return state
+
+
+def read_config(path: str) -> dict:
+    """
+    Run config stored in a checkpoint, without reading the tensors
+    """
+    with safe_open(path, framework="pt") as f:
+        return json.loads(f.metadata()["config"])
+
+
+def load_run_config(run_dir: str):
+    """
+    Resolved config of a hydra run directory, if there is one
+    """
+    config_path = os.path.join(run_dir, ".hydra/config.yaml")
+    if not os.path.exists(config_path):
+        return None
+    return OmegaConf.to_container(OmegaConf.load(config_path), resolve=True)
+
+
+def snapshot(obj):
+    """
+    Copy of a nested state with every tensor copied to the CPU, so that it can
+    be written while training keeps modifying the originals
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def save_training_state(path: str, state: dict):
+    """
+    Write a snapshot of the full training state, replacing the previous one
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_training_state(path: str) -> dict:
+    # the state holds numpy and python RNG states next to the tensors
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+class CheckpointWriter:
+    """
+    Runs checkpoint writes on a background thread, so that serialization and
+    disk I/O overlap with training. The arguments must be snapshots that
+    training no longer modifies. At most one write waits behind the one in
+    progress, so submit blocks when saves come faster than the disk.
+
+    Errors are raised in the training thread on the next submit, wait or
+    close.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        self.check()
+        self.queue.put((fn, args, kwargs))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            fn, args, kwargs = item
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                log.exception("Writing a checkpoint failed")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """
+        Block until all submitted writes are on disk
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def convert_legacy(run_dir: str, half: bool = False) -> str:
+    """
+    Convert the model_state_dict.pth, non_ema_model_state_dict.pth and
+    scaler.pth files of a run directory into a single checkpoint
+    """
+    ema_state = torch.load(
+        os.path.join(run_dir, "model_state_dict.pth"), map_location="cpu"
+    )
+    model_state = torch.load(
+        os.path.join(run_dir, "non_ema_model_state_dict.pth"), map_location="cpu"
+    )
+    scaler_state = torch.load(os.path.join(run_dir, "scaler.pth"), map_location="cpu")
+
+    path = os.path.join(run_dir, CHECKPOINT_FILE)
+    save_checkpoint(
+        path, ema_state, model_state, scaler_state, load_run_config(run_dir), half
+    )
+    return path
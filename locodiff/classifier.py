@@ -1,5 +1,7 @@
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
+
 from .utils import SinusoidalPosEmb
 
 
@@ -47,8 +49,10 @@ class ClassifierTransformer(nn.Module):
         value_mean,
         value_std,
         device,
+        checkpoint_layers=0,
     ):
         super(ClassifierTransformer, self).__init__()
+        self.checkpoint_layers = checkpoint_layers
 
         self.x_emb = nn.Linear(input_dim, d_model)
         self.cond_emb = nn.Linear(input_dim - 12, d_model)
@@ -97,7 +101,7 @@ class ClassifierTransformer(nn.Module):
         x = x + self.pos_emb
 
         x = self.encoder(x)
-        x = self.decoder(tgt=x, memory=cond, tgt_mask=self.mask)
+        x = self.decode(x, cond)
         x = self.ln_f(x)
         x = self.pred(x)
 
@@ -113,6 +117,21 @@ class ClassifierTransformer(nn.Module):
         v = self(x, cond, goal)
         return self.denormalize(v)
 
+    def decode(self, x, cond):
+        """
+        Run the decoder, recomputing the activations of the first
+        checkpoint_layers layers in the backward pass to save memory
+        """
+        if not (self.training and self.checkpoint_layers > 0):
+            return self.decoder(tgt=x, memory=cond, tgt_mask=self.mask)
+
+        for i, layer in enumerate(self.decoder.layers):
+            if i < self.checkpoint_layers:
+                x = checkpoint(layer, x, cond, tgt_mask=self.mask, use_reentrant=False)
+            else:
+                x = layer(x, cond, tgt_mask=self.mask)
+        return x
+
     def generate_mask(self, x):
         mask = (torch.triu(torch.ones(x, x)) == 1).transpose(0, 1)
         mask = (
@@ -0,0 +1,148 @@
+import json
+import os
+
+import numpy as np
+
+META_FILE = "meta.json"
+EPISODES_FILE = "episodes.npy"
+
+
+def get_episode_bounds(terminals: np.ndarray):
+    """
+    Episode starts and lengths in the flattened data. A terminal marks the
+    first step of the next episode.
+    """
+    terminals_flat = terminals.reshape(-1)
+    split_indices = np.where(terminals_flat == 1)[0]
+    ep_starts = np.concatenate([[0], split_indices]).astype(np.int64)
+    ep_lengths = np.diff(np.append(ep_starts, len(terminals_flat)))
+    return ep_starts, ep_lengths
+
+
+class ColumnarWriter:
+    """
+    Writes a dataset as one raw float32 file per field, plus a JSON header
+    with the field dims and an .npy file with the episode lengths. Episodes
+    are appended incrementally, so the data never has to fit in memory.
+
+    When writing shards, continues marks that the first episode of this shard
+    is the tail of the last episode of the previous shard.
+    """
+
+    def __init__(self, path: str, continues: bool = False):
+        self.path = path
+        self.continues = continues
+        self.files = {}
+        self.dims = {}
+        self.ep_lengths = []
+        self.num_rows = 0
+        os.makedirs(path, exist_ok=True)
+
+    def append(self, fields: dict, ep_lengths: np.ndarray):
+        """
+        Append whole episodes, where each field is a [num_rows, dim] array and
+        ep_lengths sums to num_rows
+        """
+        num_rows = int(np.sum(ep_lengths))
+        for name, x in fields.items():
+            x = np.ascontiguousarray(x, dtype=np.float32).reshape(num_rows, -1)
+            if name not in self.files:
+                self.files[name] = open(os.path.join(self.path, name + ".bin"), "wb")
+                self.dims[name] = x.shape[-1]
+            self.files[name].write(x.tobytes())
+        self.ep_lengths.append(np.asarray(ep_lengths, dtype=np.int64))
+        self.num_rows += num_rows
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        np.save(os.path.join(self.path, EPISODES_FILE), np.concatenate(self.ep_lengths))
+        meta = {
+            "num_rows": self.num_rows,
+            "dtype": "float32",
+            "dims": self.dims,
+            "continues": self.continues,
+        }
+        with open(os.path.join(self.path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+
+
+def is_columnar(path: str) -> bool:
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+def list_shards(path: str) -> list:
+    """
+    Sorted columnar subdirectories of a sharded dataset
+    """
+    shards = [os.path.join(path, d) for d in sorted(os.listdir(path))]
+    return [shard for shard in shards if is_columnar(shard)]
+
+
+def read_meta(path: str) -> dict:
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f)
+
+
+def open_columnar(path: str):
+    """
+    Memory-map every field of a columnar dataset. The maps are copy-on-write,
+    so processes share the pages and nothing is read until it is accessed.
+    """
+    meta = read_meta(path)
+
+    fields = {
+        name: np.memmap(
+            os.path.join(path, name + ".bin"),
+            dtype=meta["dtype"],
+            mode="c",
+            shape=(meta["num_rows"], dim),
+        )
+        for name, dim in meta["dims"].items()
+    }
+    ep_lengths = np.load(os.path.join(path, EPISODES_FILE))
+    ep_starts = np.concatenate([[0], np.cumsum(ep_lengths)[:-1]]).astype(np.int64)
+    return fields, ep_starts, ep_lengths
+
+
+def convert_npy(npy_path: str, path: str):
+    """
+    Convert a pickled dict of [num_episodes, T, dim] arrays with terminals, as
+    written by earlier versions of scripts/utils/preprocess.py, into the
+    columnar format
+    """
+    data = np.load(npy_path, allow_pickle=True).item()
+    _, ep_lengths = get_episode_bounds(data["terminal"])
+
+    writer = ColumnarWriter(path)
+    writer.append(
+        {key: data[key] for key in ["obs", "action", "vel_cmd", "skill"]}, ep_lengths
+    )
+    writer.close()
+
+
+def write_shards(path: str, out_path: str, rows_per_shard: int):
+    """
+    Split a columnar dataset into shards of at most rows_per_shard rows. An
+    episode that crosses a shard boundary is split, and the next shard is
+    marked as continuing it.
+    """
+    fields, ep_starts, ep_lengths = open_columnar(path)
+    num_rows = int(np.sum(ep_lengths))
+    ep_ends = ep_starts + ep_lengths
+
+    for i, start in enumerate(range(0, num_rows, rows_per_shard)):
+        end = min(start + rows_per_shard, num_rows)
+
+        # episodes overlapping [start, end), clipped to the shard
+        overlap = (ep_starts < end) & (ep_ends > start) | (
+            (ep_lengths == 0) & (ep_starts >= start) & (ep_starts < end)
+        )
+        lengths = np.minimum(ep_ends[overlap], end) - np.maximum(
+            ep_starts[overlap], start
+        )
+
+        continues = bool(start not in ep_starts)
+        writer = ColumnarWriter(os.path.join(out_path, f"{i:05d}"), continues)
+        writer.append({name: x[start:end] for name, x in fields.items()}, lengths)
+        writer.close()
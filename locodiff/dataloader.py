@@ -1,13 +1,38 @@
+import hashlib
+import json
+import math
+import multiprocessing
 import os
+import queue
+import shutil
+import threading
+import time
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset, Subset, random_split
+from torch.utils.data import (
+    DataLoader,
+    Dataset,
+    IterableDataset,
+    Subset,
+    get_worker_info,
+    random_split,
+)
 
-from locodiff.utils import MinMaxScaler
+import locodiff.columnar as columnar
+from locodiff.utils import MinMaxScaler, RunningStats
+
+DATA_DIR = os.path.dirname(os.path.realpath(__file__)) + "/../data/"
+CACHE_VERSION = 1
 
 
 class ExpertDataset(Dataset):
+    """
+    Episodes are stored back to back in flat obs and action arrays, indexed by
+    episode offsets. The T_cond - 1 steps of zero padding at the start of each
+    episode are added on access rather than stored.
+    """
+
     def __init__(
         self,
         data_directory: str,
@@ -20,14 +45,19 @@ class ExpertDataset(Dataset):
         self.T_cond = T_cond
         self.device = device
 
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-        dataset_path = current_dir + "/../data/" + data_directory + ".npy"
+        dataset_path = os.path.join(DATA_DIR, data_directory)
 
-        self.data = self.load_and_process_data(dataset_path)
+        if columnar.is_columnar(dataset_path):
+            self.data = self.load_columnar_data(dataset_path)
+        else:
+            self.data = self.load_and_process_data(dataset_path + ".npy")
 
         obs_size = list(self.data["obs"].shape)
         action_size = list(self.data["action"].shape)
-        print(f"Dataset size | Observations: {obs_size} | Actions: {action_size}")
+        print(
+            f"Dataset size | Episodes: {len(self)} | Observations: {obs_size} | "
+            f"Actions: {action_size}"
+        )
 
     # --------------
     # Initialization
@@ -36,39 +66,40 @@ class ExpertDataset(Dataset):
     def load_and_process_data(self, dataset_path):
         data = np.load(dataset_path, allow_pickle=True).item()
 
-        obs = data["obs"]
+        obs = data["obs"][..., :33]
         actions = data["action"]
         vel_cmds = data["vel_cmd"]
         skills = data["skill"]
         terminals = data["terminal"]
-    
-        obs = obs[..., :33]
 
-        # Find episode ends
-        terminals_flat = terminals.reshape(-1)
-        split_indices = np.where(terminals_flat == 1)[0]
+        obs = obs.reshape(-1, obs.shape[-1])
+        actions = actions.reshape(-1, actions.shape[-1])
+        vel_cmds = vel_cmds.reshape(-1, vel_cmds.shape[-1])
+        skills = skills.reshape(-1, skills.shape[-1])
 
-        # Split the sequences at episode ends
-        obs_splits = self.split_eps(obs, split_indices)
-        actions_splits = self.split_eps(actions, split_indices)
-        vel_cmds_splits = self.split_eps(vel_cmds, split_indices)
-        skills_splits = self.split_eps(skills, split_indices)
+        # Find episode ends
+        self.ep_starts, self.ep_lengths = columnar.get_episode_bounds(terminals)
 
-        max_len = max(split.shape[0] for split in obs_splits)
+        processed_data = {
+            "obs": self.to_tensor(obs),
+            "action": self.to_tensor(actions),
+            "vel_cmd": self.first_steps(vel_cmds),
+            "skill": self.first_steps(skills),
+        }
 
-        obs = self.add_padding(obs_splits, max_len, temporal=True)
-        actions = self.add_padding(actions_splits, max_len, temporal=True)
-        vel_cmds = self.add_padding(vel_cmds_splits, max_len, temporal=False)
-        skills = self.add_padding(skills_splits, max_len, temporal=False)
+        return processed_data
 
-        masks = self.create_masks(obs_splits, max_len)
+    def load_columnar_data(self, dataset_path):
+        """
+        Memory-map a dataset written by locodiff.columnar
+        """
+        fields, self.ep_starts, self.ep_lengths = columnar.open_columnar(dataset_path)
 
         processed_data = {
-            "obs": obs,
-            "action": actions,
-            "vel_cmd": vel_cmds,
-            "skill": skills,
-            "mask": masks,
+            "obs": self.to_tensor(fields["obs"][:, :33]),
+            "action": self.to_tensor(fields["action"]),
+            "vel_cmd": self.first_steps(fields["vel_cmd"]),
+            "skill": self.first_steps(fields["skill"]),
         }
 
         return processed_data
@@ -78,102 +109,128 @@ class ExpertDataset(Dataset):
     # -------
 
     def __len__(self):
-        return len(self.data["obs"])
+        return len(self.ep_starts)
 
     def __getitem__(self, idx):
-        T = self.data["mask"][idx].sum().int().item()
-        return {
-            key: tensor[idx, :T] for key, tensor in self.data.items() if key != "mask"
-        }
+        return self.get_window(idx, 0, self.get_seq_length(idx))
 
     def get_seq_length(self, idx):
-        return int(self.data["mask"][idx].sum().item())
+        return int(self.ep_lengths[idx]) + self.T_cond - 1
+
+    def get_window(self, idx, start, end):
+        """
+        Slice [start, end) of episode idx, where the indices include the start
+        padding
+        """
+        pad = self.T_cond - 1
+        first = self.ep_starts[idx] + max(start - pad, 0)
+        last = self.ep_starts[idx] + end - pad
+        num_pad = max(pad - start, 0)
+
+        window = {}
+        for key in ["obs", "action"]:
+            x = self.data[key][first:last]
+            if num_pad:
+                x = torch.cat([x.new_zeros(num_pad, x.shape[-1]), x])
+            window[key] = x
+        window["vel_cmd"] = self.data["vel_cmd"][idx]
+        window["skill"] = self.data["skill"][idx]
+        return window
 
     def get_all_obs(self):
-        return torch.cat(
-            [self.data["obs"][i, : self.get_seq_length(i)] for i in range(len(self))]
-        )
+        # The start padding is part of the model inputs, so it is included
+        return self.with_start_padding(self.data["obs"])
 
     def get_all_actions(self):
-        return torch.cat(
-            [self.data["action"][i, : self.get_seq_length(i)] for i in range(len(self))]
-        )
+        return self.with_start_padding(self.data["action"])
 
     def get_all_vel_cmds(self):
         return self.data["vel_cmd"].flatten()
 
+    def get_stats(self, key, chunk_size=2**16, reservoir_size=0):
+        """
+        Statistics of a temporal field, including the start padding, computed
+        one chunk at a time so memory-mapped data is never fully loaded
+        """
+        stats = RunningStats(reservoir_size)
+        x = self.data[key]
+        for start in range(0, len(x), chunk_size):
+            stats.update(x[start : start + chunk_size])
+
+        num_padding = len(self) * (self.T_cond - 1)
+        for start in range(0, num_padding, chunk_size):
+            size = min(chunk_size, num_padding - start)
+            stats.update(x.new_zeros(size, x.shape[-1]))
+        return stats
+
     # ----------------
     # Helper functions
     # ----------------
 
-    def split_eps(self, x, split_indices):
-        return np.split(x.reshape(-1, x.shape[-1]), split_indices)
-
-    def add_padding(self, splits, max_len, temporal):
-        x = []
-
-        # Make all sequences the same length
-        for split in splits:
-            pad = np.pad(split, ((0, max_len - split.shape[0]), (0, 0)))
-            reshaped_split = pad.reshape(-1, max_len, split.shape[1])
-            x.append(reshaped_split)
-        x = np.stack(x).squeeze()
-
-        if temporal:
-            # Add initial padding to handle episode starts
-            x_pad = np.zeros_like(x[:, : self.T_cond - 1, :])
-            x = np.concatenate([x_pad, x], axis=1)
-        else:
-            # For non-temporal data, e.g. skills, just take the first timestep
-            x = x[:, 0]
-
+    def to_tensor(self, x):
         return torch.from_numpy(x).to(self.device).float()
 
-    def create_masks(self, splits, max_len):
-        masks = []
-
-        # Create masks to indicate the padding values
-        for split in splits:
-            mask = np.concatenate(
-                [np.ones(split.shape[0]), np.zeros(max_len - split.shape[0])]
-            )
-            masks.append(mask)
-        masks = np.stack(masks)
-
-        # Add initial padding to handle episode starts
-        masks_pad = np.ones((masks.shape[0], self.T_cond - 1))
-        masks = np.concatenate([masks_pad, masks], axis=1)
+    def first_steps(self, x):
+        """
+        For non-temporal data, e.g. skills, just take the first timestep
+        """
+        x = x[np.minimum(self.ep_starts, len(x) - 1)]
+        x[self.ep_lengths == 0] = 0
+        return self.to_tensor(x)
 
-        return torch.from_numpy(masks).to(self.device).float()
+    def with_start_padding(self, x):
+        padding = x.new_zeros(len(self) * (self.T_cond - 1), x.shape[-1])
+        return torch.cat([padding, x])
 
 
 class SlicerWrapper(Dataset):
-    def __init__(self, dataset: Subset, T_cond: int, T: int):
+    """
+    Indexes every window of T_cond + T - 1 steps in a subset of episodes. The
+    windows are stored as per-episode counts, and a flat index is mapped to an
+    (episode, start) pair by searching the cumulative counts.
+    """
+
+    def __init__(self, dataset: Subset, T_cond: int, T: int, slices=None):
         self.dataset = dataset
         self.T_cond = T_cond
         self.T = T
-        self.slices = self._create_slices(T_cond, T)
+        if slices is None:
+            slices = self._create_slices(T_cond, T)
+        self.episodes, self.window_ends = slices
 
     def _create_slices(self, T_cond, T):
-        slices = []
         window = T_cond + T - 1
-        for i in range(len(self.dataset)):
-            length = len(self.dataset[i]["obs"])
-            if length >= window:
-                slices += [
-                    (i, start, start + window) for start in range(length - window + 1)
-                ]
-        return slices
+        episodes = np.asarray(self.dataset.indices, dtype=np.int64)
+        lengths = self.dataset.dataset.ep_lengths[episodes] + T_cond - 1
+        num_windows = np.maximum(lengths - window + 1, 0)
+
+        has_windows = num_windows > 0
+        episodes = torch.from_numpy(episodes[has_windows].astype(np.int32))
+        window_ends = torch.from_numpy(np.cumsum(num_windows[has_windows]))
+        return episodes, window_ends
 
     def __len__(self):
-        return len(self.slices)
+        return int(self.window_ends[-1]) if len(self.window_ends) else 0
 
     def __getitem__(self, idx):
-        i, start, end = self.slices[idx]
-        x = self.dataset[i]
+        episodes, starts = self.get_slices(torch.tensor([idx]))
+        i, start = int(episodes[0]), int(starts[0])
+        window = self.T_cond + self.T - 1
+        return self.dataset.dataset.get_window(i, start, start + window)
 
-        # This is to handle data without a time dimension (e.g. skills)
-        return {k: v[start:end] if v.ndim > 1 else v for k, v in x.items()}
+    def get_slices(self, idx: torch.Tensor):
+        """
+        Map flat window indices to episode indices and window starts, where
+        the starts include the episode start padding
+        """
+        i = torch.searchsorted(self.window_ends, idx, right=True)
+        first = torch.where(i > 0, self.window_ends[i - 1], 0)
+        return self.episodes[i].long(), idx - first
+
+    def to(self, device):
+        self.episodes = self.episodes.to(device)
+        self.window_ends = self.window_ends.to(device)
+        return self
 
     def get_all_obs(self):
         return self.dataset.dataset.get_all_obs()
@@ -185,6 +242,527 @@ class SlicerWrapper(Dataset):
         return self.dataset.dataset.get_all_vel_cmds()
 
 
+class WindowLoader:
+    """
+    Batches windows from a SlicerWrapper by gathering the whole batch from
+    the flat episode storage with one indexing op per key, without per-sample
+    Python or worker processes.
+
+    Given prescaled data from prescale_data, the batches are gathered on its
+    device and are already scaled and sliced like Agent.process_batch output.
+
+    Each epoch is shuffled by a generator seeded from the seed and the epoch,
+    so the order of every batch follows from the number of batches drawn and
+    seek can restore it.
+    """
+
+    def __init__(
+        self,
+        dataset: SlicerWrapper,
+        batch_size: int,
+        shuffle: bool,
+        drop_last: bool = False,
+        prescaled_data: dict = None,
+        seed: int = 0,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+
+        expert_dataset = dataset.dataset.dataset
+        self.ep_starts = torch.from_numpy(expert_dataset.ep_starts)
+        self.window = dataset.T_cond + dataset.T - 1
+        self.pad = dataset.T_cond - 1
+
+        self.prescaled = prescaled_data is not None
+        if self.prescaled:
+            self.data = prescaled_data
+            self.device = prescaled_data["obs"].device
+            self.ep_starts = self.ep_starts.to(self.device)
+            self.dataset.to(self.device)
+        else:
+            self.data = expert_dataset.data
+            self.device = "cpu"
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(
+                hash((self.seed, self.epoch)) % 2**63
+            )
+            order = torch.randperm(len(self.dataset), generator=generator)
+            order = order.to(self.device)
+        else:
+            order = torch.arange(len(self.dataset), device=self.device)
+        self.epoch += 1
+        start_batch, self.start_batch = self.start_batch, 0
+
+        for i in range(start_batch, len(self)):
+            yield self.get_batch(order[i * self.batch_size : (i + 1) * self.batch_size])
+
+    def seek(self, num_batches: int):
+        """
+        Continue as if num_batches had been drawn from a new loader, so the
+        next iterator starts in the middle of the right epoch
+        """
+        self.epoch, self.start_batch = divmod(num_batches, len(self))
+
+    def state_dict(self) -> dict:
+        return {"epoch": self.epoch, "start_batch": self.start_batch}
+
+    def load_state_dict(self, state_dict: dict):
+        self.epoch = state_dict["epoch"]
+        self.start_batch = state_dict["start_batch"]
+
+    def get_batch(self, idx: torch.Tensor) -> dict:
+        episodes, starts = self.dataset.get_slices(idx)
+        if not self.prescaled:
+            return gather_windows(
+                self.data, self.ep_starts, episodes, starts, self.window, self.pad
+            )
+
+        batch = gather_windows(
+            self.data,
+            self.ep_starts,
+            episodes,
+            starts,
+            self.window,
+            self.pad,
+            self.data["padding"],
+        )
+        batch = {k: v.float() for k, v in batch.items()}
+        batch["obs"] = batch["obs"][:, : self.pad + 1]
+        batch["action"] = batch["action"][:, self.pad :]
+        return batch
+
+
+def prescale_data(
+    dataset: ExpertDataset,
+    scaler: MinMaxScaler,
+    device: str,
+    dtype: torch.dtype = torch.float32,
+    chunk_size: int = 2**16,
+) -> dict:
+    """
+    Scale the flat obs and actions once, one chunk at a time, and store them
+    on the device in the given dtype. The start padding is zeros before
+    scaling, so its scaled values are stored separately.
+    """
+    data = {}
+    for key, scale in [("obs", scaler.scale_input), ("action", scaler.scale_output)]:
+        x = dataset.data[key]
+        data[key] = torch.empty(x.shape, dtype=dtype, device=device)
+        for start in range(0, len(x), chunk_size):
+            chunk = x[start : start + chunk_size].to(device)
+            data[key][start : start + chunk_size] = scale(chunk)
+
+    data["vel_cmd"] = dataset.data["vel_cmd"].to(device)
+    data["skill"] = dataset.data["skill"].to(device)
+    data["padding"] = {
+        "obs": scaler.scale_input(torch.zeros_like(scaler.x_min)).to(dtype),
+        "action": scaler.scale_output(torch.zeros_like(scaler.y_min)).to(dtype),
+    }
+    return data
+
+
+def gather_windows(
+    data: dict,
+    ep_starts: torch.Tensor,
+    episodes: torch.Tensor,
+    starts: torch.Tensor,
+    window: int,
+    pad: int,
+    padding: dict = None,
+) -> dict:
+    """
+    Gather windows from flat episode storage, where the starts include the
+    pad steps of start padding, which is zero unless given per key
+    """
+    ep_starts = ep_starts[episodes].unsqueeze(-1)
+
+    # rows before the episode start are the start padding
+    offsets = torch.arange(window, device=ep_starts.device)
+    rows = ep_starts + (starts - pad).unsqueeze(-1) + offsets
+    valid = (rows >= ep_starts).unsqueeze(-1)
+    rows = rows.clamp(min=0)
+
+    batch = {}
+    for key in ["obs", "action"]:
+        value = 0.0 if padding is None else padding[key]
+        batch[key] = torch.where(valid, data[key][rows], value)
+    batch["vel_cmd"] = data["vel_cmd"][episodes]
+    batch["skill"] = data["skill"][episodes]
+    return batch
+
+
+class ShardedDataset(IterableDataset):
+    """
+    Streams windows from a directory of columnar shards that together need
+    not fit in memory. Each DataLoader worker reads the shards with index
+    shard % num_workers, loading the next shards on a background thread while
+    the current one is windowed. Windows pass through a shuffle buffer and are
+    emitted as whole batches.
+
+    Episodes are assigned to the train or test split by a generator seeded
+    with the shard index, so the split doesn't depend on the worker layout.
+    An episode that continues in the next shard is completed by reading the
+    head of that shard, and belongs to the shard it starts in.
+
+    The epoch is shared with the worker processes, so persistent workers
+    reshuffle the shards of every new pass.
+    """
+
+    def __init__(
+        self,
+        data_directory: str,
+        obs_dim: int,
+        T_cond: int,
+        T: int,
+        split: str,
+        train_fraction: float,
+        batch_size: int,
+        shuffle: bool,
+        drop_last: bool = False,
+        shuffle_buffer_size: int = 0,
+        read_ahead: int = 2,
+        seed: int = 0,
+    ):
+        self.shards = columnar.list_shards(os.path.join(DATA_DIR, data_directory))
+        self.obs_dim = obs_dim
+        self.T_cond = T_cond
+        self.split = split
+        self.train_fraction = train_fraction
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.shuffle_buffer_size = shuffle_buffer_size if shuffle else 0
+        self.read_ahead = read_ahead
+        self.seed = seed
+        self.epoch = multiprocessing.Value("i", 0)
+
+        self.window = T_cond + T - 1
+        self.pad = T_cond - 1
+        self.continues = [columnar.read_meta(s)["continues"] for s in self.shards]
+
+    def set_epoch(self, epoch: int):
+        self.epoch.value = epoch
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+
+        shards = [i for i in range(len(self.shards)) if i % num_workers == worker_id]
+        generator = torch.Generator().manual_seed(
+            hash((self.seed, self.epoch.value, worker_id)) % 2**63
+        )
+        if self.shuffle:
+            order = torch.randperm(len(shards), generator=generator)
+            shards = [shards[i] for i in order]
+
+        buffer = None
+        for shard in self.read_shards(shards):
+            windows = self.get_windows(shard)
+            if buffer is not None:
+                windows = {k: torch.cat([buffer[k], v]) for k, v in windows.items()}
+            if self.shuffle:
+                order = torch.randperm(len(windows["action"]), generator=generator)
+                windows = {k: v[order] for k, v in windows.items()}
+
+            # emit batches until only the shuffle buffer is left
+            num_batches = (
+                max(len(windows["action"]) - self.shuffle_buffer_size, 0)
+                // self.batch_size
+            )
+            for i in range(num_batches):
+                yield {
+                    k: v[i * self.batch_size : (i + 1) * self.batch_size]
+                    for k, v in windows.items()
+                }
+            buffer = {k: v[num_batches * self.batch_size :] for k, v in windows.items()}
+
+        if buffer is None:
+            return
+        num_samples = len(buffer["action"])
+        for start in range(0, num_samples, self.batch_size):
+            if self.drop_last and start + self.batch_size > num_samples:
+                break
+            yield {k: v[start : start + self.batch_size] for k, v in buffer.items()}
+
+    def read_shards(self, shards: list):
+        """
+        Yield the loaded shards, reading up to read_ahead shards ahead on a
+        background thread
+        """
+        shard_queue = queue.Queue(maxsize=self.read_ahead)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    shard_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def run():
+            try:
+                for i in shards:
+                    if not put(self.load_shard(i)):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                shard = shard_queue.get()
+                if shard is None:
+                    break
+                if isinstance(shard, Exception):
+                    raise shard
+                yield shard
+        finally:
+            stop.set()
+            thread.join()
+
+    def load_shard(self, i: int) -> dict:
+        """
+        Read the episodes owned by shard i, completing the last one from the
+        heads of the following shards, and keep those in this split
+        """
+        fields, ep_starts, ep_lengths = columnar.open_columnar(self.shards[i])
+        data = {
+            "obs": [fields["obs"][:, : self.obs_dim]],
+            "action": [fields["action"]],
+        }
+        ep_lengths = ep_lengths.copy()
+
+        # peek into the next shards while they continue the last episode
+        j = i + 1
+        while j < len(self.shards) and self.continues[j] and len(ep_lengths):
+            next_fields, _, next_lengths = columnar.open_columnar(self.shards[j])
+            head = int(next_lengths[0])
+            data["obs"].append(next_fields["obs"][:head, : self.obs_dim])
+            data["action"].append(next_fields["action"][:head])
+            ep_lengths[-1] += head
+            if len(next_lengths) > 1:
+                break
+            j += 1
+
+        # the first episode belongs to the previous shard
+        first = int(self.continues[i])
+        owned = np.arange(first, len(ep_lengths))
+        generator = np.random.default_rng([self.seed, i])
+        is_train = generator.random(len(owned)) < self.train_fraction
+        episodes = owned[is_train if self.split == "train" else ~is_train]
+
+        ep_starts = np.concatenate([[0], np.cumsum(ep_lengths)[:-1]]).astype(np.int64)
+        shard = {
+            key: torch.from_numpy(np.concatenate(x)).float() for key, x in data.items()
+        }
+        for key in ["vel_cmd", "skill"]:
+            shard[key] = self.first_steps(
+                fields[key], ep_starts[episodes], ep_lengths[episodes]
+            )
+        shard["ep_starts"] = torch.from_numpy(ep_starts[episodes])
+        shard["ep_lengths"] = torch.from_numpy(ep_lengths[episodes])
+        return shard
+
+    def get_windows(self, shard: dict) -> dict:
+        """
+        All windows of the episodes in a loaded shard
+        """
+        lengths = shard["ep_lengths"] + self.pad
+        num_windows = (lengths - self.window + 1).clamp(min=0)
+
+        episodes = torch.repeat_interleave(torch.arange(len(lengths)), num_windows)
+        offsets = torch.cumsum(num_windows, 0) - num_windows
+        starts = torch.arange(len(episodes)) - offsets[episodes]
+        return gather_windows(
+            shard, shard["ep_starts"], episodes, starts, self.window, self.pad
+        )
+
+    def get_stats(self, key, chunk_size=2**16, reservoir_size=0):
+        """
+        Statistics of a temporal field over all shards, including the start
+        padding of every episode, like ExpertDataset.get_stats
+        """
+        stats = RunningStats(reservoir_size)
+        num_padding = 0
+        for shard, continues in zip(self.shards, self.continues):
+            fields, _, ep_lengths = columnar.open_columnar(shard)
+            x = fields[key][:, : self.obs_dim] if key == "obs" else fields[key]
+            for start in range(0, len(x), chunk_size):
+                stats.update(torch.from_numpy(np.array(x[start : start + chunk_size])))
+            num_padding += (len(ep_lengths) - continues) * self.pad
+
+        for start in range(0, num_padding, chunk_size):
+            size = min(chunk_size, num_padding - start)
+            stats.update(torch.zeros(size, stats.max.shape[-1]))
+        return stats
+
+    def get_all_vel_cmds(self):
+        vel_cmds = []
+        for shard, continues in zip(self.shards, self.continues):
+            fields, ep_starts, ep_lengths = columnar.open_columnar(shard)
+            first = int(continues)
+            vel_cmds.append(
+                self.first_steps(
+                    fields["vel_cmd"], ep_starts[first:], ep_lengths[first:]
+                )
+            )
+        return torch.cat(vel_cmds).flatten()
+
+    def first_steps(self, x, ep_starts, ep_lengths):
+        """
+        For non-temporal data, e.g. skills, just take the first timestep
+        """
+        x = np.array(x[np.minimum(ep_starts, len(x) - 1)])
+        x[ep_lengths == 0] = 0
+        return torch.from_numpy(x).float()
+
+
+class ShardedLoader:
+    """
+    DataLoader over a ShardedDataset that advances the dataset epoch, so the
+    shard order and shuffling differ between passes. The workers persist
+    across epochs.
+    """
+
+    def __init__(self, dataset: ShardedDataset, num_workers: int):
+        self.dataset = dataset
+        self.batch_size = dataset.batch_size
+        self.num_workers = min(num_workers, len(dataset.shards))
+        self.epoch = 0
+        self.loader = DataLoader(
+            dataset,
+            batch_size=None,
+            num_workers=self.num_workers,
+            pin_memory=True,
+            persistent_workers=self.num_workers > 0,
+        )
+
+    def __iter__(self):
+        self.dataset.set_epoch(self.epoch)
+        self.epoch += 1
+        return iter(self.loader)
+
+
+class PrefetchLoader:
+    """
+    Iterates a loader forever on a background thread, wrapping epochs, and
+    keeps up to num_prefetch batches transferred to the device ahead of the
+    consumer. On CUDA the copies run on a side stream from pinned memory.
+
+    The queue depth seen by each next() shows whether training is input
+    bound: an empty queue means the train step waited for data.
+    """
+
+    def __init__(self, loader, device: str, num_prefetch: int = 2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.queue = queue.Queue(maxsize=num_prefetch)
+        self.stop = threading.Event()
+        self.stream = None
+        if self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(self.device)
+        self.reset_metrics()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        self.depths.append(self.queue.qsize())
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.wait_time += time.perf_counter() - start
+        if isinstance(item, Exception):
+            raise item
+
+        batch, event = item
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for v in batch.values():
+                v.record_stream(current_stream)
+        return batch
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                num_batches = 0
+                for batch in self.loader:
+                    if not self.put(self.to_device(batch)):
+                        return
+                    num_batches += 1
+                if num_batches == 0:
+                    raise RuntimeError("The loader has no batches")
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item) -> bool:
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def to_device(self, batch: dict):
+        if self.stream is None:
+            return {k: v.to(self.device) for k, v in batch.items()}, None
+
+        with torch.cuda.stream(self.stream):
+            batch = {
+                k: (
+                    v.to(self.device, non_blocking=True)
+                    if v.is_cuda
+                    else v.pin_memory().to(self.device, non_blocking=True)
+                )
+                for k, v in batch.items()
+            }
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def get_metrics(self) -> dict:
+        """
+        Queue statistics since the last call
+        """
+        num_batches = max(len(self.depths), 1)
+        metrics = {
+            "prefetch_queue_depth": sum(self.depths) / num_batches,
+            "prefetch_empty_frac": self.depths.count(0) / num_batches,
+            "prefetch_wait_ms": self.wait_time / num_batches * 1e3,
+        }
+        self.reset_metrics()
+        return metrics
+
+    def reset_metrics(self):
+        self.depths = []
+        self.wait_time = 0.0
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
 def get_dataloaders_and_scaler(
     data_directory: str,
     obs_dim: int,
@@ -195,33 +773,285 @@ def get_dataloaders_and_scaler(
     train_batch_size: int,
     test_batch_size: int,
     num_workers: int,
+    drop_last: bool = False,
+    vectorized_loader: bool = False,
+    seed: int = 0,
+    use_cache: bool = False,
+    cache_dir: str = None,
+    sharded: bool = False,
+    shuffle_buffer_size: int = 0,
+    read_ahead: int = 2,
+    prescale: bool = False,
+    storage_dtype: str = "float32",
+    scaler: MinMaxScaler = None,
 ):
-    # Build the datasets
-    dataset = ExpertDataset(data_directory, obs_dim, T_cond)
-    train, val = random_split(dataset, [train_fraction, 1 - train_fraction])
-    train_set = SlicerWrapper(train, T_cond, T)
-    test_set = SlicerWrapper(val, T_cond, T)
-
-    # Build the scaler
-    x_data = train_set.get_all_obs()
-    y_data = train_set.get_all_actions()
-    cmd_data = train_set.get_all_vel_cmds()
-    scaler = MinMaxScaler(x_data, y_data, cmd_data, device)
+    """
+    Train and test loaders and the scaler of the dataset. A given scaler, e.g.
+    from a checkpoint, replaces the dataset statistics and is used to prescale
+    the data.
+    """
+    if prescale and not vectorized_loader:
+        raise ValueError("prescale requires vectorized_loader")
+    if sharded:
+        return get_sharded_dataloaders_and_scaler(
+            data_directory,
+            obs_dim,
+            T_cond,
+            T,
+            train_fraction,
+            device,
+            train_batch_size,
+            test_batch_size,
+            num_workers,
+            drop_last,
+            seed,
+            shuffle_buffer_size,
+            read_ahead,
+            scaler,
+        )
+
+    cache_path = None
+    if use_cache:
+        cache_path = get_cache_path(
+            data_directory, T_cond, T, train_fraction, seed, cache_dir
+        )
+
+    if cache_path is not None and os.path.exists(cache_path):
+        train_set, test_set, dataset_scaler = load_cache(
+            cache_path, obs_dim, T_cond, T, device
+        )
+    else:
+        # Build the datasets
+        dataset = ExpertDataset(data_directory, obs_dim, T_cond)
+        generator = torch.Generator().manual_seed(seed)
+        train, val = random_split(
+            dataset, [train_fraction, 1 - train_fraction], generator=generator
+        )
+
+        start = time.perf_counter()
+        train_set = SlicerWrapper(train, T_cond, T)
+        train_time = time.perf_counter() - start
+        test_set = SlicerWrapper(val, T_cond, T)
+        test_time = time.perf_counter() - start - train_time
+        print(
+            f"Slices | Train: {len(train_set)} in {train_time:.3f}s | "
+            f"Test: {len(test_set)} in {test_time:.3f}s"
+        )
+
+        # Build the scaler
+        x_stats = dataset.get_stats("obs")
+        y_stats = dataset.get_stats("action")
+        cmd_stats = RunningStats().update(dataset.get_all_vel_cmds())
+        dataset_scaler = MinMaxScaler.from_stats(x_stats, y_stats, cmd_stats, device)
+
+        if cache_path is not None:
+            save_cache(cache_path, dataset, train_set, test_set, dataset_scaler)
+
+    if scaler is None:
+        scaler = dataset_scaler
 
     # Build the dataloaders
-    train_dataloader = DataLoader(
-        train_set,
+    if vectorized_loader:
+        prescaled_data = None
+        if prescale:
+            dtype = getattr(torch, storage_dtype)
+            expert_dataset = train_set.dataset.dataset
+            prescaled_data = prescale_data(expert_dataset, scaler, device, dtype)
+
+        train_dataloader = WindowLoader(
+            train_set,
+            train_batch_size,
+            shuffle=True,
+            drop_last=drop_last,
+            prescaled_data=prescaled_data,
+            seed=seed,
+        )
+        test_dataloader = WindowLoader(
+            test_set,
+            test_batch_size,
+            shuffle=True,
+            prescaled_data=prescaled_data,
+            seed=seed + 1,
+        )
+    else:
+        train_dataloader = DataLoader(
+            train_set,
+            batch_size=train_batch_size,
+            shuffle=True,
+            num_workers=num_workers,
+            pin_memory=True,
+            drop_last=drop_last,
+            persistent_workers=num_workers > 0,
+        )
+        test_dataloader = DataLoader(
+            test_set,
+            batch_size=test_batch_size,
+            shuffle=True,
+            num_workers=num_workers,
+            pin_memory=True,
+            persistent_workers=num_workers > 0,
+        )
+
+    return train_dataloader, test_dataloader, scaler
+
+
+def get_sharded_dataloaders_and_scaler(
+    data_directory: str,
+    obs_dim: int,
+    T_cond: int,
+    T: int,
+    train_fraction: float,
+    device: str,
+    train_batch_size: int,
+    test_batch_size: int,
+    num_workers: int,
+    drop_last: bool,
+    seed: int,
+    shuffle_buffer_size: int,
+    read_ahead: int,
+    scaler: MinMaxScaler = None,
+):
+    common = dict(
+        data_directory=data_directory,
+        obs_dim=obs_dim,
+        T_cond=T_cond,
+        T=T,
+        train_fraction=train_fraction,
+        read_ahead=read_ahead,
+        seed=seed,
+    )
+    train_set = ShardedDataset(
+        split="train",
         batch_size=train_batch_size,
         shuffle=True,
-        num_workers=num_workers,
-        pin_memory=True,
+        drop_last=drop_last,
+        shuffle_buffer_size=shuffle_buffer_size,
+        **common,
     )
-    test_dataloader = DataLoader(
-        test_set,
-        batch_size=test_batch_size,
-        shuffle=True,
-        num_workers=num_workers,
-        pin_memory=True,
+    test_set = ShardedDataset(
+        split="test", batch_size=test_batch_size, shuffle=False, **common
     )
+    print(f"Dataset size | Shards: {len(train_set.shards)}")
+
+    # Build the scaler in one streaming pass over the shards
+    if scaler is None:
+        x_stats = train_set.get_stats("obs")
+        y_stats = train_set.get_stats("action")
+        cmd_stats = RunningStats().update(train_set.get_all_vel_cmds())
+        scaler = MinMaxScaler.from_stats(x_stats, y_stats, cmd_stats, device)
 
+    train_dataloader = ShardedLoader(train_set, num_workers)
+    test_dataloader = ShardedLoader(test_set, num_workers)
     return train_dataloader, test_dataloader, scaler
+
+
+# -------
+# Caching
+# -------
+
+
+def get_cache_path(
+    data_directory: str,
+    T_cond: int,
+    T: int,
+    train_fraction: float,
+    seed: int,
+    cache_dir: str = None,
+) -> str:
+    """
+    Cache directory for the processed dataset, keyed by the dataset contents
+    and the parameters that affect processing. The caches live in cache_dir,
+    or data/cache by default.
+    """
+    dataset_path = os.path.join(DATA_DIR, data_directory)
+    if columnar.is_columnar(dataset_path):
+        files = [
+            os.path.join(dataset_path, f) for f in sorted(os.listdir(dataset_path))
+        ]
+    else:
+        files = [dataset_path + ".npy"]
+
+    sha = hashlib.sha1()
+    for file in files:
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(2**24), b""):
+                sha.update(chunk)
+    params = {
+        "version": CACHE_VERSION,
+        "T_cond": T_cond,
+        "T": T,
+        "train_fraction": train_fraction,
+        "seed": seed,
+    }
+    sha.update(json.dumps(params, sort_keys=True).encode())
+
+    if cache_dir is None:
+        cache_dir = DATA_DIR + "cache/"
+    return os.path.join(os.path.abspath(cache_dir), sha.hexdigest())
+
+
+def save_cache(
+    cache_path: str,
+    dataset: ExpertDataset,
+    train_set: SlicerWrapper,
+    test_set: SlicerWrapper,
+    scaler: MinMaxScaler,
+):
+    """
+    Store the processed episodes in the columnar format, along with the
+    split, the slices and the scaler statistics
+    """
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+
+    # per-episode data is stored per step, like in the source datasets
+    ep_lengths = dataset.ep_lengths
+    writer = columnar.ColumnarWriter(tmp_path)
+    writer.append(
+        {
+            "obs": dataset.data["obs"].cpu().numpy(),
+            "action": dataset.data["action"].cpu().numpy(),
+            "vel_cmd": np.repeat(dataset.data["vel_cmd"].cpu().numpy(), ep_lengths, 0),
+            "skill": np.repeat(dataset.data["skill"].cpu().numpy(), ep_lengths, 0),
+        },
+        ep_lengths,
+    )
+    writer.close()
+
+    np.savez(
+        os.path.join(tmp_path, "splits.npz"),
+        train_indices=np.asarray(train_set.dataset.indices),
+        test_indices=np.asarray(test_set.dataset.indices),
+        train_episodes=train_set.episodes.numpy(),
+        train_window_ends=train_set.window_ends.numpy(),
+        test_episodes=test_set.episodes.numpy(),
+        test_window_ends=test_set.window_ends.numpy(),
+    )
+    scaler_state = {k: v.cpu() for k, v in scaler.state_dict().items()}
+    torch.save(scaler_state, os.path.join(tmp_path, "scaler.pth"))
+
+    try:
+        os.rename(tmp_path, cache_path)
+        print(f"Cached processed dataset in {cache_path}")
+    except OSError:
+        # another process wrote the same cache first
+        shutil.rmtree(tmp_path)
+
+
+def load_cache(cache_path: str, obs_dim: int, T_cond: int, T: int, device: str):
+    dataset = ExpertDataset(cache_path, obs_dim, T_cond)
+    splits = np.load(os.path.join(cache_path, "splits.npz"))
+
+    sets = []
+    for split in ["train", "test"]:
+        subset = Subset(dataset, splits[f"{split}_indices"].tolist())
+        slices = (
+            torch.from_numpy(splits[f"{split}_episodes"]),
+            torch.from_numpy(splits[f"{split}_window_ends"]),
+        )
+        sets.append(SlicerWrapper(subset, T_cond, T, slices))
+
+    scaler_state = torch.load(os.path.join(cache_path, "scaler.pth"))
+    scaler = MinMaxScaler.from_state_dict(scaler_state, device)
+    print(f"Loaded processed dataset from {cache_path}")
+
+    return sets[0], sets[1], scaler
@@ -0,0 +1,337 @@
+import copy
+import logging
+import math
+import os
+import time
+
+import hydra
+import torch
+from omegaconf import DictConfig
+from torch.func import functional_call, vmap
+from torch.nn.attention import SDPBackend, sdpa_kernel
+from tqdm import tqdm
+
+import locodiff.checkpoint as checkpoint
+import locodiff.utils as utils
+from locodiff.agent import get_val_loss, make_val_set, scale_batch
+from locodiff.dataloader import PrefetchLoader
+
+log = logging.getLogger(__name__)
+
+
+class Ensemble:
+    """
+    Trains several denoisers with the same architecture in one process, so
+    that small models fill the machine. The members are built from different
+    seeds and each has its own optimizer, learning rate, LR schedule and EMA.
+    Every step stacks their weights and runs the forward and backward pass of
+    all members at once with torch.func.vmap, on a shared batch, noise and
+    sigmas.
+
+    Each member's checkpoint is stored in member_<i> of the working directory
+    with a config that Agent.from_pretrained can build it from.
+    """
+
+    def __init__(
+        self,
+        model: DictConfig,
+        optimization: DictConfig,
+        lr_scheduler: DictConfig,
+        dataset_fn: DictConfig,
+        seeds: list,
+        lrs: list,
+        device: str,
+        max_train_steps: int,
+        eval_every_n_steps: int,
+        log_every_n_steps: int,
+        num_val_samples: int,
+        num_val_sigmas: int,
+        weight_decay: float,
+        decay: float,
+        update_ema_every_n_steps: int,
+        use_ema: bool,
+        sigma_data: float,
+        sigma_min: float,
+        sigma_max: float,
+        T_cond: int,
+        pred_obs_dim: int,
+        num_prefetch: int,
+    ):
+        if len(seeds) != len(lrs):
+            raise ValueError("seeds and lrs need one entry per member")
+        self.seeds = list(seeds)
+        self.lrs = list(lrs)
+        self.num_members = len(seeds)
+
+        # members
+        self.members = []
+        for seed in self.seeds:
+            torch.manual_seed(seed)
+            self.members.append(hydra.utils.instantiate(model).to(device))
+        # the members' weights are swapped into this copy by functional_call,
+        # activation checkpointing doesn't compose with vmap
+        self.base = copy.deepcopy(self.members[0])
+        self.base.inner_model.checkpoint_layers = 0
+        self.param_names = [n for n, _ in self.base.inner_model.named_parameters()]
+
+        total_params = sum(p.numel() for p in self.base.get_params())
+        log.info(f"{self.num_members} members of {total_params:e} parameters")
+
+        # training
+        self.optimizers = []
+        self.lr_schedulers = []
+        self.ema_helpers = []
+        for member, lr in zip(self.members, self.lrs):
+            optim_groups = member.inner_model.get_optim_groups(weight_decay)
+            optimizer = hydra.utils.instantiate(optimization, optim_groups, lr=lr)
+            self.optimizers.append(optimizer)
+            self.lr_schedulers.append(
+                hydra.utils.instantiate(lr_scheduler, optimizer=optimizer)
+            )
+            self.ema_helpers.append(
+                utils.ExponentialMovingAverage(member.get_params(), decay, device)
+            )
+        self.use_ema = use_ema
+        self.update_ema_every_n_steps = update_ema_every_n_steps
+        self.steps = 0
+        self.max_train_steps = int(max_train_steps)
+        self.eval_every_n_steps = eval_every_n_steps
+        self.log_every_n_steps = log_every_n_steps
+        self.num_val_samples = num_val_samples
+        self.num_val_sigmas = num_val_sigmas
+        self.num_prefetch = num_prefetch
+        self.best_val_losses = [math.inf] * self.num_members
+        self.train_metrics = utils.MetricsAccumulator(device)
+        self.val_set = None
+
+        # diffusion
+        self.sigma_data = sigma_data
+        self.sigma_min = sigma_min
+        self.sigma_max = sigma_max
+        self.T_cond = T_cond
+        self.pred_obs_dim = pred_obs_dim
+
+        # data, shared by all members
+        self.train_loader, self.test_loader, self.scaler = hydra.utils.instantiate(
+            dataset_fn
+        )
+        self.prescaled = getattr(self.train_loader, "prescaled", False)
+
+        # misc
+        self.device = device
+        self.working_dir = None
+        self.run_config = None
+        self.checkpoint_writer = None
+
+    def train_agent(self):
+        """
+        Main training loop
+        """
+        import wandb
+
+        self.checkpoint_writer = checkpoint.CheckpointWriter()
+        self.run_config = checkpoint.load_run_config(self.working_dir)
+        if self.num_prefetch > 0:
+            generator = PrefetchLoader(
+                self.train_loader, self.device, self.num_prefetch
+            )
+        else:
+            generator = iter(self.train_loader)
+        last_log_time = time.perf_counter()
+
+        for step in tqdm(
+            range(self.max_train_steps), position=0, leave=True, dynamic_ncols=True
+        ):
+            # validate, storing the members that improved
+            if not self.steps % self.eval_every_n_steps:
+                val_losses = self.validate()
+                for i, val_loss in enumerate(val_losses):
+                    if val_loss < self.best_val_losses[i]:
+                        self.best_val_losses[i] = val_loss
+                        self.store_model_weights(i)
+                log_info = {f"val_loss/{i}": v for i, v in enumerate(val_losses)}
+                log_info["best_val_loss"] = min(self.best_val_losses)
+                wandb.log(log_info, step=self.steps)
+
+            # train
+            try:
+                batch = next(generator)
+            except StopIteration:
+                generator = iter(self.train_loader)
+                batch = next(generator)
+            losses = self.train_step(batch)
+            self.train_metrics.add({f"loss/{i}": l for i, l in enumerate(losses)})
+            if not self.steps % self.log_every_n_steps:
+                log_info = self.train_metrics.flush()
+                log_info["steps_per_sec"] = self.log_every_n_steps / (
+                    time.perf_counter() - last_log_time
+                )
+                wandb.log(log_info, step=self.steps)
+                last_log_time = time.perf_counter()
+
+        if self.num_prefetch > 0:
+            generator.close()
+        val_losses = self.validate()
+        for i in range(self.num_members):
+            if val_losses[i] < self.best_val_losses[i]:
+                self.best_val_losses[i] = val_losses[i]
+                self.store_model_weights(i)
+        self.checkpoint_writer.close()
+        self.checkpoint_writer = None
+
+        summary = [
+            f"member {i}: lr {lr:g} | seed {seed} | best val loss {loss:.4f}"
+            for i, (lr, seed, loss) in enumerate(
+                zip(self.lrs, self.seeds, self.best_val_losses)
+            )
+        ]
+        log.info("Training done!\n" + "\n".join(summary))
+
+    def stacked_params(self) -> dict:
+        """
+        Weights of all members stacked along a new first dim. The stacking is
+        differentiable, so backward fills the members' own gradients.
+        """
+        member_params = [dict(m.inner_model.named_parameters()) for m in self.members]
+        return {
+            name: torch.stack([p[name] for p in member_params])
+            for name in self.param_names
+        }
+
+    def denoise(self, params: dict, x: torch.Tensor, sigma, data_dict: dict):
+        """
+        Inner model outputs of every member for the same input, [M, B, T, D]
+        """
+
+        def forward(member_params):
+            return functional_call(
+                self.base.inner_model, member_params, (x, sigma, data_dict)
+            )
+
+        # the fused attention kernels have no vmap batching rule and would run
+        # once per member, the math backend is batched like the other layers
+        with sdpa_kernel(SDPBackend.MATH):
+            return vmap(forward, randomness="different")(params)
+
+    def loss(self, noise, sigma, data_dict) -> torch.Tensor:
+        """
+        Denoising loss of every member, as ScalingWrapper.loss computes it
+        """
+        action = data_dict["action"]
+        noised_action = action + noise * sigma.view(-1, 1, 1)
+
+        c_skip, c_out, c_in = self.base.get_scalings(sigma)
+        params = self.stacked_params()
+        model_output = self.denoise(params, noised_action * c_in, sigma, data_dict)
+        target = (action - c_skip * noised_action) / c_out
+
+        return (model_output - target).pow(2).mean(dim=(1, 2, 3))
+
+    def train_step(self, batch: dict) -> torch.Tensor:
+        data_dict = self.process_batch(batch, self.prescaled)
+        self.set_training(True)
+
+        noise = torch.randn_like(data_dict["action"])
+        sigma = utils.rand_log_logistic(
+            (len(noise),),
+            math.log(self.sigma_data),
+            0.5,
+            self.sigma_min,
+            self.sigma_max,
+            self.device,
+        )
+        losses = self.loss(noise, sigma, data_dict)
+
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+        # the members share no weights, so the sum gives each its own gradient
+        losses.sum().backward()
+        for optimizer, lr_scheduler in zip(self.optimizers, self.lr_schedulers):
+            optimizer.step()
+            lr_scheduler.step()
+        self.steps += 1
+
+        if self.steps % self.update_ema_every_n_steps == 0:
+            for member, ema_helper in zip(self.members, self.ema_helpers):
+                ema_helper.update(member.parameters())
+        return losses.detach()
+
+    @torch.no_grad()
+    def validate(self) -> list:
+        """
+        Denoising loss of every member on the fixed validation set, with the
+        EMA weights
+        """
+        if self.val_set is None:
+            self.val_set = self.build_val_set()
+        self.set_training(False)
+        self.swap_ema()
+        val_losses = get_val_loss(
+            self.loss, self.val_set, self.test_loader.batch_size
+        ).tolist()
+        self.swap_ema(restore=True)
+        return val_losses
+
+    def build_val_set(self):
+        return make_val_set(
+            self.test_loader,
+            lambda batch: self.process_batch(batch, self.prescaled),
+            self.num_val_samples,
+            self.num_val_sigmas,
+            self.sigma_min,
+            self.sigma_max,
+            self.device,
+        )
+
+    @torch.no_grad()
+    def process_batch(self, batch: dict, prescaled: bool = False) -> dict:
+        if prescaled:
+            return batch
+        batch = {k: v.to(self.device) for k, v in batch.items()}
+        return scale_batch(batch, self.scaler, self.T_cond, self.pred_obs_dim)
+
+    def set_training(self, training: bool):
+        self.base.train(training)
+        for member in self.members:
+            member.train(training)
+
+    def swap_ema(self, restore: bool = False):
+        if not self.use_ema:
+            return
+        for member, ema_helper in zip(self.members, self.ema_helpers):
+            if restore:
+                ema_helper.restore(member.parameters())
+            else:
+                ema_helper.store(member.parameters())
+                ema_helper.copy_to(member.parameters())
+
+    def store_model_weights(self, i: int) -> None:
+        """
+        Write the checkpoint of member i on the checkpoint writer thread
+        """
+        member = self.members[i]
+        model_state = checkpoint.snapshot(member.state_dict())
+        ema_state = None
+        if self.use_ema:
+            self.ema_helpers[i].store(member.parameters())
+            self.ema_helpers[i].copy_to(member.parameters())
+            ema_state = checkpoint.snapshot(member.state_dict())
+            self.ema_helpers[i].restore(member.parameters())
+
+        # the run config with the member's seed and learning rate
+        config = None
+        if self.run_config is not None:
+            config = copy.deepcopy(self.run_config)
+            config["seed"] = self.seeds[i]
+            config["agents"]["optimization"]["lr"] = self.lrs[i]
+
+        store_path = os.path.join(self.working_dir, f"member_{i}")
+        os.makedirs(store_path, exist_ok=True)
+        self.checkpoint_writer.submit(
+            checkpoint.save_checkpoint,
+            os.path.join(store_path, checkpoint.CHECKPOINT_FILE),
+            ema_state,
+            model_state,
+            self.scaler.state_dict(),
+            config,
+        )
@@ -10,6 +10,7 @@ import hydra
 import torch
 from tqdm import trange
 
+import locodiff.checkpoint as checkpoint
 import locodiff.utils as utils
 
 log = logging.getLogger(__name__)
@@ -49,9 +50,17 @@ class JitAgent:
         self.pred_obs_dim = pred_obs_dim
         self.action_dim = action_dim
 
-        self.scaler = hydra.utils.instantiate(dataset_fn)[-1]
+        # only built from the data if no scaler is loaded from a checkpoint
+        self.dataset_fn = dataset_fn
+        self._scaler = None
         self.device = device
 
+    @property
+    def scaler(self):
+        if self._scaler is None:
+            self._scaler = hydra.utils.instantiate(self.dataset_fn)[-1]
+        return self._scaler
+
     @torch.no_grad()
     def forward(self, obs, cmd, indicator) -> torch.Tensor:
         """
@@ -110,24 +119,21 @@ class JitAgent:
         return sigma.log().neg()
 
     def load_pretrained_model(self, weights_path: str, **kwargs) -> None:
-        self.model.load_state_dict(
-            torch.load(
+        checkpoint_path = os.path.join(weights_path, checkpoint.CHECKPOINT_FILE)
+        if os.path.exists(checkpoint_path):
+            state = checkpoint.load_checkpoint(checkpoint_path)
+            model_state, scaler_state = state["ema"], state["scaler"]
+        else:
+            model_state = torch.load(
                 os.path.join(weights_path, "model_state_dict.pth"),
                 map_location=self.device,
-            ),
-            strict=False,
-        )
+            )
+            scaler_state = torch.load(
+                os.path.join(weights_path, "scaler.pth"), map_location=self.device
+            )
 
-        # Load scaler attributes
-        scaler_state = torch.load(
-            os.path.join(weights_path, "scaler.pth"), map_location=self.device
-        )
-        self.scaler.x_max = scaler_state["x_max"]
-        self.scaler.x_min = scaler_state["x_min"]
-        self.scaler.y_max = scaler_state["y_max"]
-        self.scaler.y_min = scaler_state["y_min"]
-        self.scaler.cmd_max = scaler_state["cmd_max"]
-        self.scaler.cmd_min = scaler_state["cmd_min"]
+        self.model.load_state_dict(model_state, strict=False)
+        self._scaler = utils.MinMaxScaler.from_state_dict(scaler_state, self.device)
 
         log.info("Loaded pre-trained model parameters and scaler")
 
@@ -0,0 +1,210 @@
+import threading
+
+import numpy as np
+import torch
+
+from locodiff.dataloader import gather_windows
+from locodiff.utils import MinMaxScaler
+
+
+class ReplayBuffer:
+    """
+    Bounded buffer of episodes collected while training, e.g. from RaisimEnv
+    rollouts, windowed like ExpertDataset. The steps live in a ring buffer of
+    capacity rows and every episode is stored contiguously, wrapping to the
+    start when it doesn't fit before the end. Episodes that a new one
+    overwrites are evicted.
+
+    The number of windows of each episode slot is updated on insertion and
+    eviction, so sampling draws episodes in proportion to their window counts
+    without rebuilding an index.
+
+    Sampling uses its own generator, as it runs on the prefetch thread and
+    must not consume the global RNG of the training loop.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        T_cond: int,
+        T: int,
+        device: str = "cpu",
+        seed: int = 0,
+    ):
+        self.capacity = capacity
+        self.window = T_cond + T - 1
+        self.pad = T_cond - 1
+        self.device = device
+        self.lock = threading.Lock()
+        self.generator = torch.Generator(device=device).manual_seed(seed)
+
+        # allocated on the first episode, when the field dims are known
+        self.data = None
+        self.ep_starts = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.ep_lengths = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.num_windows = torch.zeros(capacity, device=device)
+        self.pos = 0
+        self.next_slot = 0
+
+    def __len__(self):
+        return int(self.num_windows.sum())
+
+    @property
+    def num_episodes(self):
+        return int((self.ep_lengths > 0).sum())
+
+    def add_episode(
+        self,
+        obs: np.ndarray,
+        action: np.ndarray,
+        vel_cmd: np.ndarray,
+        skill: np.ndarray,
+    ):
+        """
+        Append one episode of [length, dim] obs and actions with its velocity
+        command and skill
+        """
+        length = min(len(obs), self.capacity)
+        if length == 0:
+            return
+        obs = torch.as_tensor(obs[-length:], device=self.device).float()
+        action = torch.as_tensor(action[-length:], device=self.device).float()
+
+        with self.lock:
+            if self.data is None:
+                self.data = {
+                    "obs": obs.new_zeros(self.capacity, obs.shape[-1]),
+                    "action": action.new_zeros(self.capacity, action.shape[-1]),
+                    "vel_cmd": obs.new_zeros(self.capacity, len(vel_cmd)),
+                    "skill": obs.new_zeros(self.capacity, len(skill)),
+                }
+
+            if self.pos + length > self.capacity:
+                self.pos = 0
+            start, end = self.pos, self.pos + length
+
+            # evict the episodes in the rows being written and in the slot
+            ep_ends = self.ep_starts + self.ep_lengths
+            evicted = (self.ep_lengths > 0) & (self.ep_starts < end) & (ep_ends > start)
+            evicted[self.next_slot] = True
+            self.ep_lengths[evicted] = 0
+            self.num_windows[evicted] = 0
+
+            slot = self.next_slot
+            self.data["obs"][start:end] = obs
+            self.data["action"][start:end] = action
+            self.data["vel_cmd"][slot] = torch.as_tensor(vel_cmd, device=self.device)
+            self.data["skill"][slot] = torch.as_tensor(skill, device=self.device)
+            self.ep_starts[slot] = start
+            self.ep_lengths[slot] = length
+            self.num_windows[slot] = max(length + self.pad - self.window + 1, 0)
+
+            self.pos = end
+            self.next_slot = (slot + 1) % self.capacity
+
+    def sample(self, batch_size: int) -> dict:
+        """
+        Sample windows uniformly, with replacement. Returns None while the
+        buffer has no windows.
+        """
+        with self.lock:
+            # checked under the lock, add_episode can evict the last windows
+            if self.num_windows.sum() == 0:
+                return None
+            episodes = torch.multinomial(
+                self.num_windows, batch_size, True, generator=self.generator
+            )
+            starts = torch.rand(
+                batch_size, generator=self.generator, device=self.device
+            )
+            starts = (starts * self.num_windows[episodes]).long()
+            return gather_windows(
+                self.data, self.ep_starts, episodes, starts, self.window, self.pad
+            )
+
+
+class MixedLoader:
+    """
+    Replaces a fraction replay_ratio of every batch from the expert loader
+    with windows sampled from a replay buffer, once the buffer has any. The
+    batch size stays the same, so training shapes are static.
+    """
+
+    def __init__(
+        self,
+        loader,
+        replay_buffer: ReplayBuffer,
+        replay_ratio: float,
+        scaler: MinMaxScaler,
+    ):
+        self.loader = loader
+        self.replay_buffer = replay_buffer
+        self.replay_ratio = replay_ratio
+        self.scaler = scaler
+        self.batch_size = loader.batch_size
+        self.prescaled = getattr(loader, "prescaled", False)
+        if hasattr(loader, "seek"):
+            self.seek = loader.seek
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield self.mix(batch)
+
+    def mix(self, batch: dict) -> dict:
+        num_samples = len(batch["action"])
+        num_replay = round(num_samples * self.replay_ratio)
+        if num_replay == 0:
+            return batch
+
+        replay = self.replay_buffer.sample(num_replay)
+        if replay is None:
+            return batch
+        if self.prescaled:
+            # match the scaled and sliced batches of the expert loader
+            replay["obs"] = self.scaler.scale_input(replay["obs"][:, : self.pad + 1])
+            replay["action"] = self.scaler.scale_output(replay["action"][:, self.pad :])
+
+        num_expert = num_samples - num_replay
+        return {
+            k: torch.cat([v[:num_expert], replay[k].to(v.device)])
+            for k, v in batch.items()
+        }
+
+    @property
+    def pad(self):
+        return self.replay_buffer.pad
+
+
+def split_rollout(
+    obs: np.ndarray,
+    action: np.ndarray,
+    vel_cmd: np.ndarray,
+    skill: np.ndarray,
+    reset: np.ndarray,
+) -> list:
+    """
+    Split [num_envs, steps, dim] rollouts into episodes for the replay buffer.
+    A new episode starts where an environment was reset and where the velocity
+    command changes, so that each episode has a single command like the
+    expert data.
+    """
+    episodes = []
+    for i in range(len(obs)):
+        starts = reset[i].copy()
+        starts[1:] |= np.any(vel_cmd[i, 1:] != vel_cmd[i, :-1], axis=-1)
+        starts[0] = True
+
+        bounds = np.append(np.where(starts)[0], obs.shape[1])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            episodes.append(
+                {
+                    "obs": obs[i, start:end],
+                    "action": action[i, start:end],
+                    "vel_cmd": vel_cmd[i, start],
+                    "skill": skill[i],
+                }
+            )
+    return episodes
@@ -0,0 +1,105 @@
+import csv
+import itertools
+import logging
+import math
+import os
+import random
+
+import hydra
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from locodiff.checkpoint import TRAINING_STATE_FILE, load_training_state
+
+log = logging.getLogger(__name__)
+
+
+def sample_params(parameters: dict, num_trials: int, method: str, seed: int = 0):
+    """
+    Parameter sets from the parameters section of a wandb sweep spec. The grid
+    method enumerates every combination of value/values entries, the other
+    methods sample num_trials sets at random. Ranges with int bounds sample
+    ints, log_uniform_values ranges sample on a log scale.
+    """
+    if method == "grid":
+        for key, spec in parameters.items():
+            if "value" not in spec and "values" not in spec:
+                raise ValueError(f"Grid search needs value or values for {key}")
+        keys = list(parameters)
+        choices = [
+            parameters[k].get("values", [parameters[k].get("value")]) for k in keys
+        ]
+        return [dict(zip(keys, c)) for c in itertools.product(*choices)][:num_trials]
+
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(num_trials * 100):
+        if len(trials) == num_trials:
+            break
+        trial = {}
+        for key, spec in parameters.items():
+            if "value" in spec:
+                trial[key] = spec["value"]
+            elif "values" in spec:
+                trial[key] = rng.choice(spec["values"])
+            elif spec.get("distribution") == "log_uniform_values":
+                low, high = math.log(spec["min"]), math.log(spec["max"])
+                trial[key] = math.exp(rng.uniform(low, high))
+            elif isinstance(spec["min"], int) and isinstance(spec["max"], int):
+                trial[key] = rng.randint(spec["min"], spec["max"])
+            else:
+                trial[key] = rng.uniform(spec["min"], spec["max"])
+        if trial not in trials:
+            trials.append(trial)
+    return trials
+
+
+def get_budgets(min_steps: int, max_steps: int, eta: int) -> list:
+    """
+    Step budgets of the successive halving rungs, growing by eta up to the
+    full number of train steps
+    """
+    budgets = []
+    steps = min_steps
+    while steps < max_steps:
+        budgets.append(steps)
+        steps *= eta
+    return budgets + [max_steps]
+
+
+def run_trial(cfg: dict, trial_dir: str, steps: int, num_threads: int) -> float:
+    """
+    Train a trial up to steps, continuing from its previous rung, and return
+    the validation loss at the last step. Runs in a fresh process.
+    """
+    import wandb
+
+    torch.set_num_threads(num_threads)
+    cfg = OmegaConf.create(cfg)
+    np.random.seed(cfg.seed)
+    torch.manual_seed(cfg.seed)
+    wandb.init(mode="disabled")
+
+    agent = hydra.utils.instantiate(cfg.agents)
+    state_path = os.path.join(trial_dir, TRAINING_STATE_FILE)
+    if os.path.exists(state_path):
+        agent.load_training_state(load_training_state(state_path))
+
+    # the LR schedule still spans the full run
+    agent.max_train_steps = steps
+    agent.working_dir = trial_dir
+    agent.train_agent()
+    agent.save_training_state(trial_dir)
+    return agent.val_loss
+
+
+def write_results(path: str, trials: list):
+    keys = list(trials[0]["params"])
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["trial"] + keys + ["steps", "val_loss", "status"])
+        for i, trial in enumerate(trials):
+            params = [trial["params"][k] for k in keys]
+            row = [trial["steps"], trial["val_loss"], trial["status"]]
+            writer.writerow([i] + params + row)
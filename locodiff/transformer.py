@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
 from .utils import SinusoidalPosEmb
 
 
@@ -18,6 +20,7 @@ class DiffusionTransformer(nn.Module):
         device,
         cond_mask_prob,
         dropout,
+        checkpoint_layers=0,
     ):
         super().__init__()
         self.obs_dim = obs_dim
@@ -29,6 +32,9 @@ class DiffusionTransformer(nn.Module):
         self.num_layers = num_layers
         self.device = device
         self.cond_mask_prob = cond_mask_prob
+        self.checkpoint_layers = checkpoint_layers
+        # None lets the decoder check whether the mask is causal
+        self.tgt_is_causal = None
 
         self.state_action_emb = nn.Linear(
             self.pred_obs_dim + self.act_dim, self.d_model
@@ -188,12 +194,36 @@ class DiffusionTransformer(nn.Module):
         cond = self.encoder(cond)
 
         input_emb += self.pos_emb
-        x = self.decoder(tgt=input_emb, memory=cond, tgt_mask=self.mask)
+        x = self.decode(input_emb, cond)
         x = self.ln_f(x)
         out = self.state_action_pred(x)
 
         return out
 
+    def decode(self, x, cond):
+        """
+        Run the decoder, recomputing the activations of the first
+        checkpoint_layers layers in the backward pass to save memory
+        """
+        if not (self.training and self.checkpoint_layers > 0):
+            return self.decoder(
+                tgt=x, memory=cond, tgt_mask=self.mask, tgt_is_causal=self.tgt_is_causal
+            )
+
+        for i, layer in enumerate(self.decoder.layers):
+            if i < self.checkpoint_layers:
+                x = checkpoint(
+                    layer,
+                    x,
+                    cond,
+                    tgt_mask=self.mask,
+                    tgt_is_causal=True,
+                    use_reentrant=False,
+                )
+            else:
+                x = layer(x, cond, tgt_mask=self.mask, tgt_is_causal=True)
+        return x
+
     def generate_mask(self, x):
         mask = (torch.triu(torch.ones(x, x)) == 1).transpose(0, 1)
         mask = (
@@ -1,8 +1,15 @@
+import logging
 import math
+import os
+import time
+from collections import defaultdict, deque
+
 import numpy as np
 import torch
 import torch.nn as nn
 
+log = logging.getLogger(__name__)
+
 
 def get_sigmas_exponential(n, sigma_min, sigma_max, device="cpu"):
     """Constructs an exponential noise schedule."""
@@ -12,6 +19,15 @@ def get_sigmas_exponential(n, sigma_min, sigma_max, device="cpu"):
     return torch.cat([sigmas, sigmas.new_zeros([1])])
 
 
+def get_sigmas_karras(n, sigma_min, sigma_max, rho=7.0, device="cpu"):
+    """Constructs the noise schedule of Karras et al. (2022)."""
+    ramp = torch.linspace(0, 1, n, device=device)
+    min_inv_rho = sigma_min ** (1 / rho)
+    max_inv_rho = sigma_max ** (1 / rho)
+    sigmas = (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
+    return torch.cat([sigmas, sigmas.new_zeros([1])])
+
+
 def rand_log_logistic(
     shape,
     loc=0.0,
@@ -146,6 +162,310 @@ class ExponentialMovingAverage:
         self.shadow_params = state_dict["shadow_params"]
 
 
+class MetricsAccumulator:
+    """
+    Keeps running sums of scalar metrics on the device, so that logging only
+    synchronizes with the host when the averages are computed.
+    """
+
+    def __init__(self, device: str):
+        self.device = device
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, metrics: dict, n: int = 1):
+        """
+        Add a dict of scalar tensors (or numbers), weighted by n.
+        """
+        for key, value in metrics.items():
+            value = torch.as_tensor(value, device=self.device).detach()
+            if key not in self.sums:
+                self.sums[key] = torch.zeros((), device=self.device)
+                self.counts[key] = 0
+            self.sums[key] += value * n
+            self.counts[key] += n
+
+    def compute(self) -> dict:
+        """
+        Return the averages as python floats, with a single host sync.
+        """
+        if not self.sums:
+            return {}
+        keys = list(self.sums)
+        means = torch.stack([self.sums[k] / self.counts[k] for k in keys])
+        return dict(zip(keys, means.tolist()))
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def flush(self) -> dict:
+        metrics = self.compute()
+        self.reset()
+        return metrics
+
+    def state_dict(self) -> dict:
+        return {"sums": dict(self.sums), "counts": dict(self.counts)}
+
+    def load_state_dict(self, state_dict: dict):
+        self.sums = {k: v.to(self.device) for k, v in state_dict["sums"].items()}
+        self.counts = dict(state_dict["counts"])
+
+
+class CompiledFunction:
+    """
+    Wrapper around torch.compile that logs how long the compilation for each
+    new input signature takes.
+    """
+
+    def __init__(self, fn, name: str, **compile_kwargs):
+        self.fn = torch.compile(fn, **compile_kwargs)
+        self.name = name
+        self.signatures = set()
+
+    def __call__(self, *args, **kwargs):
+        signature = self.get_signature(args, kwargs)
+        if signature in self.signatures:
+            return self.fn(*args, **kwargs)
+
+        start = time.perf_counter()
+        out = self.fn(*args, **kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        log.info(
+            f"Compiled {self.name} for {signature} in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+        self.signatures.add(signature)
+        return out
+
+    def get_signature(self, args, kwargs):
+        values = list(args) + list(kwargs.values())
+        signature = []
+        for value in values:
+            if isinstance(value, dict):
+                values += list(value.values())
+            elif isinstance(value, torch.Tensor):
+                signature.append(tuple(value.shape))
+            else:
+                signature.append(value)
+        return tuple(signature) + (torch.is_grad_enabled(),)
+
+
+class StepProfiler:
+    """
+    Runs torch.profiler for num_steps steps from start_step, after one warmup
+    step. A step is whatever the caller counts, train steps in train_agent and
+    control steps in RaisimEnv.simulate. When the window closes the trace is
+    exported to out_dir as {name}_step{n}.json, for chrome://tracing or
+    Perfetto, and a table of the ops with the most self time is logged.
+    Disabled, step does nothing.
+    """
+
+    def __init__(
+        self,
+        out_dir: str,
+        device: str,
+        current_step: int = 0,
+        enabled: bool = False,
+        start_step: int = 100,
+        num_steps: int = 5,
+        record_shapes: bool = False,
+        with_stack: bool = False,
+        row_limit: int = 20,
+        name: str = "trace",
+    ):
+        if enabled and start_step < 1:
+            raise ValueError(
+                f"Profiler start_step must be at least 1, got {start_step}: "
+                "the step before it is the warmup step"
+            )
+        self.row_limit = row_limit
+        self.out_dir = out_dir
+        self.name = name
+        self.cuda = str(device).startswith("cuda")
+        self.prof = None
+
+        # the warmup step comes before start_step
+        skip_first = start_step - 1 - current_step
+        if not enabled:
+            return
+        if skip_first < 0:
+            log.warning(f"Profiler window at step {start_step} has passed")
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.prof = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                skip_first=skip_first, wait=0, warmup=1, active=num_steps, repeat=1
+            ),
+            on_trace_ready=self.report,
+            record_shapes=record_shapes,
+            with_stack=with_stack,
+        )
+        self.prof.start()
+
+    def step(self):
+        if self.prof is not None:
+            self.prof.step()
+
+    def stop(self):
+        if self.prof is not None:
+            self.prof.stop()
+            self.prof = None
+
+    def report(self, prof):
+        path = os.path.join(self.out_dir, f"{self.name}_step{prof.step_num}.json")
+        prof.export_chrome_trace(path)
+
+        sort_by = "self_cuda_time_total" if self.cuda else "self_cpu_time_total"
+        table = prof.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)
+        log.info(f"Profiled steps up to {prof.step_num}, trace in {path}\n{table}")
+
+
+class LatencyTimer:
+    """
+    Wall-clock timers for the stages of a call like Agent.predict. start
+    begins a call, each lap records the time since the previous lap under a
+    stage name and stop records the total. On CUDA every lap synchronizes so
+    that kernels count towards the stage that launched them. The last
+    max_samples durations of each stage are kept for the percentiles.
+
+    Disabled, the methods return immediately.
+    """
+
+    def __init__(self, enabled: bool, device: str, max_samples: int = 100000):
+        self.enabled = enabled
+        self.cuda = str(device).startswith("cuda")
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        self.samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+
+    def now(self) -> float:
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.call_start = self.last = self.now()
+
+    def lap(self, stage: str):
+        if not self.enabled:
+            return
+        now = self.now()
+        self.samples[stage].append(now - self.last)
+        self.last = now
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.lap("other")
+        self.samples["total"].append(self.last - self.call_start)
+
+    def summary(self, percentiles=(50, 95, 99)) -> dict:
+        """
+        Percentiles of every stage in ms, keyed like latency/<stage>_p<q>_ms
+        """
+        summary = {}
+        for stage, samples in self.samples.items():
+            values = np.percentile(np.array(samples) * 1e3, percentiles)
+            for q, value in zip(percentiles, values):
+                summary[f"latency/{stage}_p{q}_ms"] = value
+        return summary
+
+    def table(self) -> str:
+        rows = [
+            "| stage | calls | p50 (ms) | p95 (ms) | p99 (ms) |",
+            "|---|---|---|---|---|",
+        ]
+        for stage, samples in self.samples.items():
+            p50, p95, p99 = np.percentile(np.array(samples) * 1e3, (50, 95, 99))
+            rows.append(
+                f"| {stage} | {len(samples)} | {p50:.3f} | {p95:.3f} | {p99:.3f} |"
+            )
+        return "\n".join(rows)
+
+
+class RunningStats:
+    """
+    Min, max, mean and variance over a stream of chunks, computed in a single
+    pass. Percentiles are optionally estimated from a fixed-size reservoir
+    sample of the rows.
+    """
+
+    def __init__(self, reservoir_size: int = 0):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = None
+        self.m2 = None
+        self.reservoir_size = reservoir_size
+        self.reservoir = None
+
+    def update(self, x: torch.Tensor):
+        """
+        Add a chunk of rows, reducing over the first dimension
+        """
+        if len(x) == 0:
+            return self
+        x = x.detach()
+        x_64 = x.double()
+        count = len(x)
+        mean = x_64.mean(0)
+        m2 = (x_64 - mean).pow(2).sum(0)
+
+        if self.count == 0:
+            self.min, self.max = x.min(0).values, x.max(0).values
+            self.mean, self.m2 = mean, m2
+        else:
+            # combine with the previous chunks (Chan et al.)
+            total = self.count + count
+            delta = mean - self.mean
+            self.mean = self.mean + delta * count / total
+            self.m2 = self.m2 + m2 + delta.pow(2) * self.count * count / total
+            self.min = torch.minimum(self.min, x.min(0).values)
+            self.max = torch.maximum(self.max, x.max(0).values)
+
+        if self.reservoir_size > 0:
+            self.update_reservoir(x)
+        self.count += count
+        return self
+
+    def update_reservoir(self, x: torch.Tensor):
+        if self.reservoir is None:
+            self.reservoir = x.new_empty((self.reservoir_size,) + x.shape[1:])
+
+        # fill the reservoir first, then replace rows with decreasing probability
+        num_fill = max(min(self.reservoir_size - self.count, len(x)), 0)
+        self.reservoir[self.count : self.count + num_fill] = x[:num_fill]
+
+        idx = torch.arange(self.count + num_fill, self.count + len(x))
+        slots = (torch.rand(len(idx)) * (idx + 1)).long()
+        keep = slots < self.reservoir_size
+        self.reservoir[slots[keep]] = x[num_fill:][keep.to(x.device)]
+
+    @property
+    def var(self):
+        return self.m2 / max(self.count - 1, 1)
+
+    @property
+    def std(self):
+        return self.var.sqrt()
+
+    def percentile(self, q: float):
+        if self.reservoir is None:
+            raise RuntimeError("Percentiles need a reservoir_size > 0")
+        sample = self.reservoir[: min(self.count, self.reservoir_size)]
+        return torch.quantile(sample.double(), q / 100, dim=0)
+
+
 class MinMaxScaler:
     """
     Min Max scaler, that scales the output data between -1 and 1 and the input to a uniform Gaussian.
@@ -170,6 +490,55 @@ class MinMaxScaler:
         self.y_bounds[0, :] = -1.1
         self.y_bounds[1, :] = 1.1
 
+    @classmethod
+    def from_stats(
+        cls,
+        x_stats: RunningStats,
+        y_stats: RunningStats,
+        cmd_stats: RunningStats,
+        device: str,
+    ):
+        """
+        Build a scaler from streamed statistics, without holding the data
+        """
+        state_dict = {
+            "x_max": x_stats.max,
+            "x_min": x_stats.min,
+            "y_max": y_stats.max,
+            "y_min": y_stats.min,
+            "cmd_max": cmd_stats.max,
+            "cmd_min": cmd_stats.min,
+        }
+        return cls.from_state_dict(state_dict, device)
+
+    @classmethod
+    def from_state_dict(cls, state_dict: dict, device: str):
+        """
+        Build a scaler from stored statistics, without any data
+        """
+        scaler = cls.__new__(cls)
+        scaler.device = device
+        scaler.load_state_dict(state_dict)
+
+        scaler.y_bounds = torch.zeros((2, scaler.y_max.shape[-1])).to(device)
+        scaler.y_bounds[0, :] = -1.1
+        scaler.y_bounds[1, :] = 1.1
+        return scaler
+
+    def state_dict(self):
+        return {
+            "x_max": self.x_max,
+            "x_min": self.x_min,
+            "y_max": self.y_max,
+            "y_min": self.y_min,
+            "cmd_max": self.cmd_max,
+            "cmd_min": self.cmd_min,
+        }
+
+    def load_state_dict(self, state_dict: dict):
+        for key, value in state_dict.items():
+            setattr(self, key, value.to(self.device))
+
     def update_pos_scale(self, batch, T_cond):
         obs_batch = batch["obs"]
         # goal_batch = batch["goal"]
@@ -0,0 +1,91 @@
+import logging
+import math
+import resource
+import time
+
+import hydra
+import torch
+import torch.multiprocessing as mp
+from omegaconf import DictConfig, OmegaConf
+
+import locodiff.utils as utils
+from common import make_batch
+
+log = logging.getLogger(__name__)
+
+NUM_WARMUP_STEPS = 3
+NUM_STEPS = 20
+
+
+def peak_memory(device: str) -> float:
+    """
+    Peak memory in MB, resident set size on the CPU
+    """
+    if device.startswith("cuda"):
+        return torch.cuda.max_memory_allocated() / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def run(cfg: dict, checkpoint_layers: int) -> tuple:
+    """
+    Train for a few steps in a fresh process and return the increase in peak
+    memory over the model setup and the steps/sec
+    """
+    cfg = OmegaConf.create(cfg)
+    cfg.agents.model.inner_model.checkpoint_layers = checkpoint_layers
+    torch.manual_seed(cfg.seed)
+
+    model = hydra.utils.instantiate(cfg.agents.model).to(cfg.device)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    data_dict = make_batch(cfg, cfg.agents.dataset_fn.train_batch_size)
+    noise = torch.randn_like(data_dict["action"])
+    sigma = utils.rand_log_logistic(
+        (len(noise),), math.log(cfg.sigma_data), 0.5, 0.001, 80, cfg.device
+    )
+    base_memory = peak_memory(cfg.device)
+
+    def train_step():
+        loss = model.loss(noise, sigma, data_dict)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(NUM_WARMUP_STEPS):
+        train_step()
+    if cfg.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(NUM_STEPS):
+        train_step()
+    if cfg.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    steps_per_sec = NUM_STEPS / (time.perf_counter() - start)
+
+    return peak_memory(cfg.device) - base_memory, steps_per_sec
+
+
+@hydra.main(config_path="../../configs", config_name="config.yaml", version_base=None)
+def main(cfg: DictConfig) -> None:
+    cfg = OmegaConf.to_container(cfg, resolve=True)
+    ctx = mp.get_context("spawn")
+
+    rows = []
+    for checkpoint_layers in range(cfg["num_hidden_layers"] + 1):
+        with ctx.Pool(1) as pool:
+            memory, steps_per_sec = pool.apply(run, (cfg, checkpoint_layers))
+        rows.append((checkpoint_layers, memory, steps_per_sec))
+
+    table = [
+        f"d_model {cfg['hidden_dim']} | layers {cfg['num_hidden_layers']} | "
+        f"batch size {cfg['agents']['dataset_fn']['train_batch_size']}",
+        "| checkpoint_layers | peak memory (MB) | steps/sec |",
+        "|---|---|---|",
+    ]
+    for checkpoint_layers, memory, steps_per_sec in rows:
+        table.append(f"| {checkpoint_layers} | {memory:.0f} | {steps_per_sec:.2f} |")
+    log.info("\n" + "\n".join(table))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import torch
+from omegaconf import DictConfig
+
+
+def make_batch(cfg: DictConfig, batch_size: int) -> dict:
+    """
+    Random batch with the shapes produced by Agent.process_batch
+    """
+    sa_dim = cfg.pred_obs_dim + cfg.action_dim
+    return {
+        "obs": torch.randn(batch_size, cfg.T_cond, cfg.obs_dim, device=cfg.device),
+        "action": torch.randn(batch_size, cfg.T, sa_dim, device=cfg.device),
+        "vel_cmd": torch.randn(batch_size, 3, device=cfg.device),
+        "skill": torch.zeros(batch_size, cfg.skill_dim, device=cfg.device),
+    }
@@ -0,0 +1,88 @@
+import logging
+import math
+import time
+
+import hydra
+import torch
+from omegaconf import DictConfig
+
+import locodiff.utils as utils
+from common import make_batch
+
+log = logging.getLogger(__name__)
+
+NUM_WARMUP_STEPS = 10
+NUM_STEPS = 100
+
+
+def timeit(fn, device: str, num_steps: int) -> float:
+    """
+    Average seconds per call
+    """
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps
+
+
+def benchmark(name: str, eager_fn, compiled_fn, device: str):
+    start = time.perf_counter()
+    compiled_fn()
+    compile_time = time.perf_counter() - start
+
+    for _ in range(NUM_WARMUP_STEPS):
+        eager_fn()
+        compiled_fn()
+    eager = timeit(eager_fn, device, NUM_STEPS)
+    compiled = timeit(compiled_fn, device, NUM_STEPS)
+
+    log.info(
+        f"{name}: compile {compile_time:.1f}s | eager {eager * 1e3:.2f}ms | "
+        f"compiled {compiled * 1e3:.2f}ms | speedup {eager / compiled:.2f}x"
+    )
+
+
+@hydra.main(config_path="../../configs", config_name="config.yaml", version_base=None)
+def main(cfg: DictConfig) -> None:
+    torch.manual_seed(cfg.seed)
+    model = hydra.utils.instantiate(cfg.agents.model).to(cfg.device)
+    data_dict = make_batch(cfg, cfg.agents.dataset_fn.train_batch_size)
+    noise = torch.randn_like(data_dict["action"])
+    sigma = utils.rand_log_logistic(
+        (len(noise),), math.log(cfg.sigma_data), 0.5, 0.001, 80, cfg.device
+    )
+    compiled_loss = torch.compile(model.loss, dynamic=False)
+    compiled_model = torch.compile(model, dynamic=False)
+
+    def train_step(loss_fn):
+        model.zero_grad()
+        loss_fn(noise, sigma, data_dict).backward()
+
+    model.train()
+    benchmark(
+        "training step",
+        lambda: train_step(model.loss),
+        lambda: train_step(compiled_loss),
+        cfg.device,
+    )
+
+    # one denoising step at the rollout batch size
+    model.eval()
+    data_dict = make_batch(cfg, cfg.env.num_envs)
+    x_t = torch.randn_like(data_dict["action"])
+    sigma = torch.full((cfg.env.num_envs,), 1.0, device=cfg.device)
+    with torch.no_grad():
+        benchmark(
+            "denoiser",
+            lambda: model(x_t, sigma, data_dict),
+            lambda: compiled_model(x_t, sigma, data_dict),
+            cfg.device,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__)) + "/../../"
+
+# modules that should only be imported by the code paths that use them
+HEAVY_MODULES = ["wandb", "matplotlib", "scipy", "sklearn", "imageio"]
+
+
+def import_time(module: str) -> list:
+    """
+    Run python -X importtime in a fresh interpreter and return the
+    (cumulative seconds, module) pairs it reports
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT_DIR,
+        env={**os.environ, "PYTHONPATH": ROOT_DIR},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times.append((int(cumulative) / 1e6, name.strip()))
+    return times
+
+
+def main():
+    # the repo has no CI, so this check only runs when invoked by hand, e.g.
+    # before merging changes that touch module level imports
+    parser = argparse.ArgumentParser(
+        description="Measure import times and exit with an error if they exceed "
+        "the budget or pull in heavy modules"
+    )
+    parser.add_argument(
+        "--module", type=str, help="module to import", default="locodiff.agent"
+    )
+    parser.add_argument("--budget", type=float, help="seconds", default=3.0)
+    parser.add_argument("--repeats", type=int, help="best of n runs", default=3)
+    parser.add_argument("--top", type=int, help="slowest imports to show", default=10)
+    args = parser.parse_args()
+
+    # the best run is the least affected by a cold disk cache
+    runs = [import_time(args.module) for _ in range(args.repeats)]
+    times = min(runs, key=lambda run: run[-1][0])
+    total = times[-1][0]
+
+    print(f"import {args.module}: {total:.2f}s (budget {args.budget:.2f}s)")
+    print("| cumulative (s) | module |")
+    print("|---|---|")
+    for seconds, name in sorted(times, reverse=True)[1 : args.top + 1]:
+        print(f"| {seconds:.3f} | {name} |")
+
+    imported = {name for _, name in times}
+    heavy = [m for m in HEAVY_MODULES if m in imported]
+    if heavy:
+        print(f"FAIL: import {args.module} pulls in {', '.join(heavy)}")
+    if total > args.budget:
+        print(f"FAIL: {total:.2f}s is over the budget")
+    if heavy or total > args.budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
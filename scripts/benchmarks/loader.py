@@ -0,0 +1,46 @@
+import logging
+import time
+
+import hydra
+import torch
+from omegaconf import DictConfig
+
+log = logging.getLogger(__name__)
+
+NUM_BATCHES = 50
+
+
+def samples_per_sec(loader) -> float:
+    generator = iter(loader)
+    next(generator)  # worker startup
+
+    num_samples = 0
+    start = time.perf_counter()
+    for _ in range(NUM_BATCHES):
+        try:
+            batch = next(generator)
+        except StopIteration:
+            generator = iter(loader)
+            batch = next(generator)
+        num_samples += len(batch["action"])
+    return num_samples / (time.perf_counter() - start)
+
+
+@hydra.main(config_path="../../configs", config_name="config.yaml", version_base=None)
+def main(cfg: DictConfig) -> None:
+    torch.manual_seed(cfg.seed)
+
+    results = {}
+    for vectorized_loader in [False, True]:
+        train_loader, _, _ = hydra.utils.instantiate(
+            cfg.agents.dataset_fn, vectorized_loader=vectorized_loader
+        )
+        results[vectorized_loader] = samples_per_sec(train_loader)
+
+    log.info(f"DataLoader + SlicerWrapper: {results[False]:.0f} samples/sec")
+    log.info(f"WindowLoader: {results[True]:.0f} samples/sec")
+    log.info(f"speedup: {results[True] / results[False]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import logging
+import math
+import time
+
+import hydra
+import torch
+from omegaconf import DictConfig
+
+import locodiff.utils as utils
+from common import make_batch
+
+log = logging.getLogger(__name__)
+
+NUM_WARMUP_STEPS = 20
+NUM_STEPS = 200
+LOG_EVERY_N_STEPS = 100
+
+
+def train_step(model, optimizer, data_dict, cfg):
+    noise = torch.randn_like(data_dict["action"])
+    sigma = utils.rand_log_logistic(
+        (len(noise),), math.log(cfg.sigma_data), 0.5, 0.001, 80, cfg.device
+    )
+    loss = model.loss(noise, sigma, data_dict)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    return loss.detach()
+
+
+def run(model, optimizer, data_dict, cfg, sync: bool) -> float:
+    """
+    Returns steps/sec, either syncing the loss every step or accumulating it
+    """
+    metrics = utils.MetricsAccumulator(cfg.device)
+    for _ in range(NUM_WARMUP_STEPS):
+        train_step(model, optimizer, data_dict, cfg)
+
+    if cfg.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for step in range(1, NUM_STEPS + 1):
+        loss = train_step(model, optimizer, data_dict, cfg)
+        if sync:
+            loss = loss.item()
+        metrics.add({"loss": loss})
+        if not step % LOG_EVERY_N_STEPS:
+            metrics.flush()
+    if cfg.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return NUM_STEPS / (time.perf_counter() - start)
+
+
+@hydra.main(config_path="../../configs", config_name="config.yaml", version_base=None)
+def main(cfg: DictConfig) -> None:
+    torch.manual_seed(cfg.seed)
+    model = hydra.utils.instantiate(cfg.agents.model).to(cfg.device)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    data_dict = make_batch(cfg, cfg.agents.dataset_fn.train_batch_size)
+
+    synced = run(model, optimizer, data_dict, cfg, sync=True)
+    accumulated = run(model, optimizer, data_dict, cfg, sync=False)
+
+    log.info(f"loss.item() every step: {synced:.1f} steps/sec")
+    log.info(f"on-device accumulation: {accumulated:.1f} steps/sec")
+    log.info(f"speedup: {accumulated / synced:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
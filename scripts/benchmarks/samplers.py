@@ -0,0 +1,238 @@
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import logging
+import os
+import subprocess
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+import locodiff.utils as utils
+from locodiff.agent import Agent
+
+log = logging.getLogger(__name__)
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__)) + "/../../"
+
+SCHEDULES = {
+    "exponential": utils.get_sigmas_exponential,
+    "karras": utils.get_sigmas_karras,
+}
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def int_list(s: str) -> list:
+    return [int(x) for x in s.split(",")]
+
+
+def str_list(s: str) -> list:
+    return s.split(",")
+
+
+def git_commit() -> str:
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() or "unknown"
+
+
+def load_agent(run_dir: str, device: str) -> Agent:
+    """
+    Agent of a training run for inference on the given device, with the
+    stored weights used directly
+    """
+    cfg = OmegaConf.load(os.path.join(run_dir, ".hydra/config.yaml"))
+    cfg.device = device
+    cfg.agents.device = device
+    cfg.use_ema = False
+    cfg.compile_model = False
+    return Agent.from_pretrained(run_dir, cfg)
+
+
+def sample(agent: Agent, sampler: str, schedule: str, steps: int, data_dict, noise):
+    sigmas = SCHEDULES[schedule](
+        steps, agent.sigma_min, agent.sigma_max, device=agent.device
+    )
+    sample_fn = agent.sample_ddim if sampler == "ddim" else agent.sample_euler
+    return sample_fn(noise * agent.sigma_max, sigmas, data_dict, predict=False)
+
+
+def autocast(device: str, precision: str):
+    if PRECISIONS[precision] is None:
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=PRECISIONS[precision])
+
+
+def action_mse(agent: Agent, sampler, schedule, steps, precision, val_set, batch_size):
+    """
+    MSE of the sampled actions on the fixed validation windows
+    """
+    data_dict, noise, _ = val_set
+    num_samples = len(data_dict["action"])
+    total = 0.0
+    for start in range(0, num_samples, batch_size):
+        batch = {k: v[start : start + batch_size] for k, v in data_dict.items()}
+        with autocast(agent.device, precision):
+            x_0 = sample(
+                agent,
+                sampler,
+                schedule,
+                steps,
+                batch,
+                noise[0, start : start + batch_size],
+            )
+        error = (x_0.float() - batch["action"])[..., agent.pred_obs_dim :] ** 2
+        total += error.mean(dim=(1, 2)).sum().item()
+    return total / num_samples
+
+
+def latency(
+    agent: Agent, sampler, schedule, steps, precision, val_set, batch_size, repeats
+):
+    """
+    Wall-clock seconds of sampling one batch, over repeats runs after warmup
+    """
+    data_dict, noise, _ = val_set
+    # repeat the windows if the batch is larger than the validation set
+    idx = torch.arange(batch_size, device=agent.device) % len(data_dict["action"])
+    batch = {k: v[idx] for k, v in data_dict.items()}
+    batch_noise = noise[0, idx]
+
+    times = []
+    for i in range(repeats + 3):
+        if agent.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with autocast(agent.device, precision):
+            sample(agent, sampler, schedule, steps, batch, batch_noise)
+        if agent.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        if i >= 3:
+            times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def mark_pareto(rows: list):
+    """
+    Flag the rows that no other row with the same batch size beats on both
+    latency and action MSE
+    """
+    for row in rows:
+        row["pareto"] = not any(
+            other["batch_size"] == row["batch_size"]
+            and other["latency_p50_ms"] <= row["latency_p50_ms"]
+            and other["action_mse"] <= row["action_mse"]
+            and (
+                other["latency_p50_ms"] < row["latency_p50_ms"]
+                or other["action_mse"] < row["action_mse"]
+            )
+            for other in rows
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure action MSE, latency and throughput of the samplers "
+        "and write a Pareto table that can be compared across commits"
+    )
+    parser.add_argument("run_dir", type=str, help="training run directory")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--samplers", type=str_list, default="ddim,euler")
+    parser.add_argument("--steps", type=int_list, default="1,2,3,5,10,20,50")
+    parser.add_argument("--precisions", type=str_list, default="fp32,bf16")
+    parser.add_argument("--batch-sizes", type=int_list, default="1,16,64,256")
+    parser.add_argument("--schedules", type=str_list, default="exponential,karras")
+    parser.add_argument("--num-samples", type=int, help="test windows", default=1024)
+    parser.add_argument("--repeats", type=int, help="timed runs", default=20)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--out", type=str, help="output prefix", default="samplers")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    agent = load_agent(args.run_dir, args.device)
+    agent.model.eval()
+
+    # the first test windows with fixed noise, the same for every commit
+    agent.num_val_samples = args.num_samples
+    val_set = agent.build_val_set()
+
+    rows = []
+    for sampler, schedule, steps, precision in itertools.product(
+        args.samplers, args.schedules, args.steps, args.precisions
+    ):
+        mse = action_mse(
+            agent, sampler, schedule, steps, precision, val_set, max(args.batch_sizes)
+        )
+        for batch_size in args.batch_sizes:
+            times = latency(
+                agent,
+                sampler,
+                schedule,
+                steps,
+                precision,
+                val_set,
+                batch_size,
+                args.repeats,
+            )
+            p50, p95 = np.percentile(times * 1e3, (50, 95))
+            rows.append(
+                {
+                    "sampler": sampler,
+                    "schedule": schedule,
+                    "steps": steps,
+                    "precision": precision,
+                    "batch_size": batch_size,
+                    "action_mse": mse,
+                    "latency_p50_ms": p50,
+                    "latency_p95_ms": p95,
+                    "samples_per_sec": batch_size / np.median(times),
+                }
+            )
+            log.info(
+                f"{sampler} {schedule} {steps} steps {precision} batch {batch_size}: "
+                f"mse {mse:.5f} | p50 {p50:.2f}ms | p95 {p95:.2f}ms"
+            )
+    mark_pareto(rows)
+
+    meta = {
+        "commit": git_commit(),
+        "torch": torch.__version__,
+        "device": args.device,
+        "num_threads": torch.get_num_threads(),
+        "run_dir": args.run_dir,
+        "num_samples": len(val_set[0]["action"]),
+    }
+    with open(args.out + ".json", "w") as f:
+        json.dump({"meta": meta, "results": rows}, f, indent=2)
+    with open(args.out + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    table = [
+        "| sampler | schedule | steps | precision | batch | action mse | p50 (ms) | samples/s |",
+        "|---|---|---|---|---|---|---|---|",
+    ]
+    for row in rows:
+        if row["pareto"]:
+            table.append(
+                f"| {row['sampler']} | {row['schedule']} | {row['steps']} | "
+                f"{row['precision']} | {row['batch_size']} | {row['action_mse']:.5f} | "
+                f"{row['latency_p50_ms']:.2f} | {row['samples_per_sec']:.0f} |"
+            )
+    log.info(f"Pareto front at commit {meta['commit']}\n" + "\n".join(table))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,15 @@
 import os
 import logging
 import numpy as np
-import matplotlib.pyplot as plt
 
 import hydra
 from omegaconf import DictConfig, OmegaConf
 import torch
 from tqdm import tqdm
-from scipy.spatial.transform import Rotation as R
-from sklearn.manifold import TSNE
 
 from env.raisim_env import RaisimEnv
+from locodiff.agent import Agent
+from locodiff.utils import StepProfiler
 
 
 log = logging.getLogger(__name__)
@@ -41,8 +40,7 @@ def main(cfg: DictConfig) -> None:
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
 
-    agent = hydra.utils.instantiate(model_cfg.agents)
-    agent.load_pretrained_model(cfg.model_store_path)
+    agent = Agent.from_pretrained(cfg.model_store_path, model_cfg)
     # agent = torch.jit.load(f"data/models/policy_{cfg.device}.pt")
     env = RaisimEnv(model_cfg)
 
@@ -50,15 +48,25 @@ def main(cfg: DictConfig) -> None:
     agent.sigma_max = cfg.sigma_max
     agent.sigma_min = cfg.sigma_min
     agent.cond_lambda = cfg.cond_lambda
+    agent.latency.enabled = cfg.latency_timers
+    # counts control steps across all the rollouts below
+    profiler = StepProfiler(os.getcwd(), cfg.device, **cfg.profiler)
 
     # Evaluate
     if cfg["test_rollout"]:
         env.eval_n_times = cfg["num_runs"]
         results_dict = env.simulate(
-            agent, n_inference_steps=cfg["n_inference_steps"], real_time=True
+            agent,
+            n_inference_steps=cfg["n_inference_steps"],
+            real_time=True,
+            profiler=profiler,
         )
         print(results_dict)
     else:
+        # plotting is only needed for the offline tests
+        import matplotlib.pyplot as plt
+        from scipy.spatial.transform import Rotation as R
+
         dataloader = agent.test_loader
         batch = next(iter(dataloader))
         batch = {k: v.to(cfg.device) for k, v in batch.items()}
@@ -83,7 +91,7 @@ def main(cfg: DictConfig) -> None:
             for step in inference_steps:
                 agent.num_sampling_steps = step
                 info = agent.evaluate(batch)
-                results.append(info["total_mse"])
+                results.append(info["total_mse"].item())
             plt.plot(inference_steps, results, "x")
         if cfg["test_observation_error"]:
             info = agent.evaluate(batch)
@@ -157,9 +165,14 @@ def main(cfg: DictConfig) -> None:
 
                 axs[i].legend()
         if cfg["test_t_sne"]:
+            from sklearn.manifold import TSNE
+
             env.eval_n_times = 10
             results_dict = env.simulate(
-                agent, n_inference_steps=cfg["n_inference_steps"], real_time=True
+                agent,
+                n_inference_steps=cfg["n_inference_steps"],
+                real_time=True,
+                profiler=profiler,
             )
 
             obs_dim = 36
@@ -194,7 +207,10 @@ def main(cfg: DictConfig) -> None:
             for i, lam in enumerate(lambda_values):
                 agent.cond_lambda = lam
                 results_dict = env.simulate(
-                    agent, n_inference_steps=cfg["n_inference_steps"], real_time=True
+                    agent,
+                    n_inference_steps=cfg["n_inference_steps"],
+                    real_time=True,
+                    profiler=profiler,
                 )
                 reward = np.exp(-((results_dict["x_pos"] - 0.6) ** 2)*10)
                 # reward = ((results_dict["x_pos"] > 0.5 ) & (results_dict["x_pos"] < 0.8)).astype(float)
@@ -221,6 +237,9 @@ def main(cfg: DictConfig) -> None:
         #     else:
         #         plt.savefig("results.png")
 
+    profiler.stop()
+    env.close()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,168 @@
+import argparse
+import logging
+import math
+import os
+import time
+
+import hydra
+import torch.multiprocessing as mp
+from hydra import compose, initialize_config_dir
+from omegaconf import OmegaConf
+
+from locodiff.sweep import get_budgets, run_trial, sample_params, write_results
+
+log = logging.getLogger(__name__)
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__)) + "/../"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a wandb sweep spec locally, training several trials at "
+        "once and pruning them with successive halving on the validation loss"
+    )
+    parser.add_argument("overrides", nargs="*", help="base config overrides")
+    parser.add_argument(
+        "--spec",
+        type=str,
+        help="wandb sweep spec",
+        default=ROOT_DIR + "configs/sweeps/sweep.yaml",
+    )
+    parser.add_argument("--num-workers", type=int, help="concurrent trials", default=2)
+    parser.add_argument(
+        "--devices", type=str, help="comma separated, defaults to the config device"
+    )
+    parser.add_argument("--out", type=str, help="output directory", default=None)
+    parser.add_argument("--seed", type=int, help="parameter sampling seed", default=0)
+    parser.add_argument(
+        "--num-trials", type=int, help="trials in the first rung", default=27
+    )
+    parser.add_argument(
+        "--min-steps", type=int, help="steps of the first rung", default=4000
+    )
+    parser.add_argument(
+        "--eta", type=int, help="1/eta of the trials continue per rung", default=3
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    spec = OmegaConf.to_container(OmegaConf.load(args.spec))
+    with initialize_config_dir(config_dir=ROOT_DIR + "configs", version_base=None):
+        base_cfg = compose("config", overrides=args.overrides)
+
+        # keys of older specs that the config no longer has would fail to compose
+        parameters = {}
+        for key, value in spec["parameters"].items():
+            if OmegaConf.select(base_cfg, key) is None:
+                log.warning(f"Skipping {key}, it is not in the config")
+            else:
+                parameters[key] = value
+
+        method = spec.get("method", "random")
+        if method == "bayes":
+            log.info("Bayesian search needs the wandb server, sampling at random")
+        params = sample_params(parameters, args.num_trials, method, args.seed)
+
+        # trials continue from their training state between rungs, so the
+        # periodic checkpoints are not needed
+        devices = args.devices.split(",") if args.devices else [base_cfg.device]
+        shared = args.num_workers > len(devices)
+        cfgs = []
+        for i, trial_params in enumerate(params):
+            device = devices[i % len(devices)]
+            overrides = args.overrides + [f"{k}={v}" for k, v in trial_params.items()]
+            overrides += [
+                f"device={device}",
+                "checkpoint_every_n_steps=0",
+                "agents.dataset_fn.use_cache=True",
+            ]
+            # a prescaled copy per trial would defeat the shared memory-mapped
+            # cache on the CPU, and crowd a device that trials share
+            if shared or device.startswith("cpu"):
+                overrides.append("agents.dataset_fn.prescale=False")
+            cfg = compose("config", overrides=overrides)
+            cfgs.append(OmegaConf.to_container(cfg, resolve=True))
+
+    out_dir = args.out or os.path.join(
+        ROOT_DIR,
+        "logs/sweeps",
+        spec.get("name", "sweep"),
+        time.strftime("%Y-%m-%d_%H-%M-%S"),
+    )
+    trial_dirs = []
+    for i, cfg in enumerate(cfgs):
+        trial_dirs.append(os.path.join(out_dir, f"trial_{i}"))
+        os.makedirs(os.path.join(trial_dirs[-1], ".hydra"), exist_ok=True)
+        OmegaConf.save(cfg, os.path.join(trial_dirs[-1], ".hydra/config.yaml"))
+
+    # build each dataset cache once, the trials memory-map it
+    dataset_cfgs = {OmegaConf.to_yaml(cfg["agents"]["dataset_fn"]) for cfg in cfgs}
+    for dataset_cfg in dataset_cfgs:
+        hydra.utils.instantiate(
+            OmegaConf.create(dataset_cfg),
+            device="cpu",
+            vectorized_loader=True,
+            prescale=False,
+        )
+
+    max_steps = int(float(cfgs[0]["max_train_steps"]))
+    eta = args.eta
+    budgets = get_budgets(min(args.min_steps, max_steps), max_steps, eta)
+    log.info(f"{len(cfgs)} trials, rungs at {budgets} steps, results in {out_dir}")
+
+    trials = [
+        {"params": p, "steps": 0, "val_loss": math.inf, "status": "pending"}
+        for p in params
+    ]
+    alive = list(range(len(trials)))
+    num_threads = max(os.cpu_count() // args.num_workers, 1)
+    results_path = os.path.join(out_dir, "results.csv")
+
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(args.num_workers, maxtasksperchild=1) as pool:
+        for rung, steps in enumerate(budgets):
+            start = time.perf_counter()
+            results = {
+                i: pool.apply_async(
+                    run_trial, (cfgs[i], trial_dirs[i], steps, num_threads)
+                )
+                for i in alive
+            }
+            for i, result in results.items():
+                try:
+                    trials[i]["val_loss"] = result.get()
+                    trials[i]["steps"] = steps
+                    trials[i]["status"] = "running"
+                except Exception:
+                    log.exception(f"Trial {i} failed")
+                    trials[i]["status"] = "failed"
+
+            alive = [i for i in alive if trials[i]["status"] == "running"]
+            alive.sort(key=lambda i: trials[i]["val_loss"])
+            if rung < len(budgets) - 1:
+                for i in alive[max(len(alive) // eta, 1) :]:
+                    trials[i]["status"] = "pruned"
+                alive = alive[: max(len(alive) // eta, 1)]
+            else:
+                for i in alive:
+                    trials[i]["status"] = "complete"
+
+            write_results(results_path, trials)
+            log.info(
+                f"Rung {rung} ({steps} steps) took {time.perf_counter() - start:.0f}s, "
+                f"{len(alive)} trials continue"
+            )
+
+    ranked = sorted(range(len(trials)), key=lambda i: trials[i]["val_loss"])
+    table = ["| trial | steps | val_loss | status | params |", "|---|---|---|---|---|"]
+    for i in ranked:
+        trial = trials[i]
+        table.append(
+            f"| {i} | {trial['steps']} | {trial['val_loss']:.4f} | "
+            f"{trial['status']} | {trial['params']} |"
+        )
+    log.info("\n" + "\n".join(table))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import logging
+import sys
+
+import hydra
+import numpy as np
+import torch
+from omegaconf import DictConfig, OmegaConf
+
+import wandb
+
+log = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="../configs", config_name="ensemble.yaml", version_base=None)
+def main(cfg: DictConfig) -> None:
+
+    # set seeds, the members are seeded from cfg.ensemble.seeds
+    np.random.seed(cfg.seed)
+    torch.manual_seed(cfg.seed)
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = True
+
+    # debug mode
+    if sys.gettrace() is not None:
+        mode = "disabled"
+    else:
+        mode = "online"
+
+    # init wandb
+    wandb.config = OmegaConf.to_container(cfg, resolve=True, throw_on_missing=True)
+    output_dir = hydra.core.hydra_config.HydraConfig.get().runtime.output_dir
+    wandb.init(
+        project=cfg.wandb.project, mode=mode, config=wandb.config, dir=output_dir
+    )
+
+    ensemble = hydra.utils.instantiate(cfg.ensemble)
+    ensemble.working_dir = output_dir
+    ensemble.train_agent()
+
+    log.info("done")
+    wandb.finish()
+
+
+if __name__ == "__main__":
+    main()
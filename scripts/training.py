@@ -9,12 +9,19 @@ from omegaconf import DictConfig, OmegaConf
 
 import wandb
 from env.raisim_env import RaisimEnv
+from env.sim_worker import SimWorker
+from locodiff.checkpoint import TRAINING_STATE_FILE, load_training_state
 
 log = logging.getLogger(__name__)
 
 
 @hydra.main(config_path="../configs", config_name="config.yaml", version_base=None)
 def main(cfg: DictConfig) -> None:
+    # resume a run in its own directory, with its own config
+    run_dir = cfg.resume
+    if run_dir is not None:
+        run_dir = hydra.utils.to_absolute_path(run_dir)
+        cfg = OmegaConf.load(os.path.join(run_dir, ".hydra/config.yaml"))
 
     # set seeds
     np.random.seed(cfg.seed)
@@ -30,18 +37,40 @@ def main(cfg: DictConfig) -> None:
     else:
         mode = "online"
 
+    state = None
+    if run_dir is not None:
+        output_dir = run_dir
+        state = load_training_state(os.path.join(run_dir, TRAINING_STATE_FILE))
+    else:
+        output_dir = hydra.core.hydra_config.HydraConfig.get().runtime.output_dir
+
     # init wandb
     wandb.config = OmegaConf.to_container(cfg, resolve=True, throw_on_missing=True)
-    output_dir = hydra.core.hydra_config.HydraConfig.get().runtime.output_dir
     wandb.init(
-        project=cfg.wandb.project, mode=mode, config=wandb.config, dir=output_dir
+        project=cfg.wandb.project,
+        mode=mode,
+        config=wandb.config,
+        dir=output_dir,
+        id=state["wandb_run_id"] if state is not None else None,
+        resume="allow" if state is not None else None,
     )
 
     agent = hydra.utils.instantiate(cfg.agents)
-    agent.env = RaisimEnv(cfg)
+    if state is not None:
+        agent.load_training_state(state)
+    if cfg.async_sim:
+        # rollout results are logged against the step they were started at
+        wandb.define_metric("sim_step")
+        for key in ["avrg_reward", "std_reward", "total_done"]:
+            wandb.define_metric(key, step_metric="sim_step")
+        agent.sim_worker = SimWorker(cfg, output_dir)
+    else:
+        agent.env = RaisimEnv(cfg)
     agent.working_dir = output_dir
 
     agent.train_agent()
+    if agent.env is not None:
+        agent.env.close()
 
     log.info("done")
     wandb.finish()
@@ -0,0 +1,29 @@
+import argparse
+import os
+
+from locodiff.checkpoint import convert_legacy
+
+# Parser
+parser = argparse.ArgumentParser(
+    description="Convert the .pth weights of a run into a single safetensors checkpoint"
+)
+parser.add_argument("run_dirs", type=str, nargs="+", help="run directories")
+parser.add_argument(
+    "--fp16", action="store_true", help="store the inference weights in fp16"
+)
+parser.add_argument(
+    "--remove", action="store_true", help="delete the .pth files after converting"
+)
+args = parser.parse_args()
+
+for run_dir in args.run_dirs:
+    path = convert_legacy(run_dir, half=args.fp16)
+    print(f"Converted {run_dir} to {path}")
+    if args.remove:
+        for name in [
+            "model_state_dict.pth",
+            "non_ema_model_state_dict.pth",
+            "scaler.pth",
+        ]:
+            os.remove(os.path.join(run_dir, name))
+print("done")
@@ -0,0 +1,38 @@
+import argparse
+import os
+
+from locodiff.columnar import convert_npy, is_columnar, write_shards
+
+# Parser
+parser = argparse.ArgumentParser(
+    description="Convert a pickled .npy dataset into the memory-mapped columnar format"
+)
+parser.add_argument("name", type=str, help="dataset name, e.g. walk_crawl")
+parser.add_argument(
+    "-o", type=str, help="output name, defaults to the dataset name", default=None
+)
+parser.add_argument(
+    "--rows-per-shard",
+    type=int,
+    help="split the columnar dataset into shards of this many rows",
+    default=None,
+)
+args = parser.parse_args()
+
+data_dir = os.path.dirname(os.path.realpath(__file__)) + "/../../data/"
+npy_path = data_dir + args.name + ".npy"
+
+if args.rows_per_shard is None:
+    out_path = data_dir + (args.o or args.name)
+    print(f"Converting {npy_path} to {out_path}/")
+    convert_npy(npy_path, out_path)
+else:
+    columnar_path = data_dir + args.name
+    if not is_columnar(columnar_path):
+        print(f"Converting {npy_path} to {columnar_path}/")
+        convert_npy(npy_path, columnar_path)
+
+    out_path = data_dir + (args.o or args.name + "_shards")
+    print(f"Sharding {columnar_path}/ into {out_path}/")
+    write_shards(columnar_path, out_path, args.rows_per_shard)
+print("done")
@@ -1,14 +1,47 @@
-import numpy as np
+import argparse
 import os
-import matplotlib.pyplot as plt
+import tempfile
+from multiprocessing import Pool
 
+import numpy as np
 
-def load_data(data_path):
-    return np.load(data_path, allow_pickle=True).item()
+from locodiff.columnar import ColumnarWriter, get_episode_bounds
+
+data_dir = os.path.dirname(os.path.realpath(__file__)) + "/../../data/"
 
+KEYS = ["observations", "actions", "vel_cmds", "terminals"]
 
-def cat(x1, x2):
-    return {k: np.concatenate((x1[k], x2[k]), axis=0) for k in x1.keys()}
+# raw sources opened by this process, so each worker opens a source only once
+sources = {}
+
+
+def load_data(data_path):
+    """
+    Memory-map a raw source directory with one .npy file per key
+    """
+    if data_path not in sources:
+        sources[data_path] = {
+            key: np.load(os.path.join(data_path, key + ".npy"), mmap_mode="r")
+            for key in KEYS
+        }
+    return sources[data_path]
+
+
+def convert_source(data_path, out_path):
+    """
+    Write a pickled source dict to one .npy file per key, so the workers
+    memory-map it instead of each loading the whole source
+    """
+    data = np.load(data_path, allow_pickle=True).item()
+    os.makedirs(out_path)
+    for key in KEYS:
+        np.save(os.path.join(out_path, key + ".npy"), data[key])
+    return out_path
+
+
+def get_source_path(name):
+    path = data_dir + "raw/" + name
+    return path if os.path.isdir(path) else path + ".npy"
 
 
 def shift_terminals(terminals):
@@ -39,39 +72,115 @@ def split_by_vel_cmd(obs, terminals):
     return terminals
 
 
-data_dir = os.path.dirname(os.path.realpath(__file__)) + "/../../data/"
-walk_data = load_data(data_dir + "raw/walk.npy")
-crawl_data = load_data(data_dir + "raw/crawl.npy")
-
-# roll actions (only need this for pmtg)
-act = np.roll(walk_data["actions"], -1, axis=1)
-act[:, -1] = act[:, -2].copy()
-walk_data["actions"] = act.copy()
-
-data = cat(walk_data, crawl_data)
-
-obs = data["observations"]
-act = data["actions"]
-terminals = data["terminals"]
-vel_cmds = data["vel_cmds"]
-
-terminals = shift_terminals(terminals)
-
-skill = np.zeros_like(vel_cmds[..., :2])
-skill[:1000, :, 0] = 1
-skill[1000:, :, 1] = 1
-
-processed_data = {
-    "obs": obs,
-    "action": act,
-    "vel_cmd": vel_cmds,
-    "skill": skill,
-    "terminal": terminals,
-}
-
-# Save the data to a new file
-name = "walk_crawl"
-print(f"Saving data to {data_dir}/{name}.npy")
-print(f"Observations shape: {obs.shape}, Actions shape: {act.shape}")
-np.save(f"{data_dir}/{name}.npy", processed_data)
-print("done")
+def process_chunk(args):
+    """
+    Process episodes [start, end) of one source into flat fields and episode
+    lengths. Chunks start at an episode boundary, so they are independent.
+    """
+    path, start, end, skill_idx, num_skills, roll_actions, split_vel_cmd = args
+    data = load_data(path)
+
+    obs = np.array(data["observations"][start:end])
+    act = np.array(data["actions"][start:end])
+    vel_cmds = np.array(data["vel_cmds"][start:end])
+    terminals = np.array(data["terminals"][start:end])
+
+    # roll actions (only need this for pmtg)
+    if roll_actions:
+        act = np.roll(act, -1, axis=1)
+        act[:, -1] = act[:, -2].copy()
+
+    terminals = shift_terminals(terminals)
+    if split_vel_cmd:
+        terminals = split_by_vel_cmd(obs, terminals)
+
+    skill = np.zeros(vel_cmds.shape[:-1] + (num_skills,), dtype=vel_cmds.dtype)
+    skill[..., skill_idx] = 1
+
+    _, ep_lengths = get_episode_bounds(terminals)
+    fields = {"obs": obs, "action": act, "vel_cmd": vel_cmds, "skill": skill}
+    return fields, ep_lengths
+
+
+def get_chunks(args, tmp_dir):
+    chunks = []
+    for skill_idx, name in enumerate(args.sources):
+        path = get_source_path(name)
+        if not os.path.isdir(path):
+            print(f"Converting {path} for memory-mapping")
+            path = convert_source(path, os.path.join(tmp_dir, name))
+        num_episodes = len(load_data(path)["observations"])
+        for start in range(0, num_episodes, args.chunk_size):
+            end = min(start + args.chunk_size, num_episodes)
+            chunks.append(
+                (
+                    path,
+                    start,
+                    end,
+                    skill_idx,
+                    len(args.sources),
+                    name in args.roll_actions,
+                    args.split_vel_cmd,
+                )
+            )
+        # the workers open the source themselves
+        sources.pop(path)
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Preprocess raw rollouts into the columnar training format"
+    )
+    parser.add_argument(
+        "--sources",
+        type=str,
+        nargs="+",
+        help="raw sources in data/raw/, one skill per source",
+        default=["walk", "crawl"],
+    )
+    parser.add_argument(
+        "--roll-actions",
+        type=str,
+        nargs="*",
+        help="sources whose actions are shifted one step back",
+        default=["walk"],
+    )
+    parser.add_argument("--name", type=str, help="output name", default="walk_crawl")
+    parser.add_argument(
+        "--chunk-size", type=int, help="episodes per chunk", default=100
+    )
+    parser.add_argument(
+        "--num-workers", type=int, help="worker processes", default=os.cpu_count()
+    )
+    parser.add_argument(
+        "--split-vel-cmd",
+        action="store_true",
+        help="also start a new episode where the velocity command changes",
+    )
+    args = parser.parse_args()
+
+    out_path = data_dir + args.name
+    writer = ColumnarWriter(out_path)
+
+    # converted pickled sources are kept next to the output until the end
+    with tempfile.TemporaryDirectory(dir=data_dir) as tmp_dir:
+        chunks = get_chunks(args, tmp_dir)
+        print(f"Processing {len(chunks)} chunks from {args.sources}")
+
+        with Pool(args.num_workers) as pool:
+            # imap yields the chunks in order, so episodes keep their source order
+            results = pool.imap(process_chunk, chunks)
+            for i, (fields, ep_lengths) in enumerate(results):
+                writer.append(fields, ep_lengths)
+                print(
+                    f"Chunk {i + 1}/{len(chunks)} | Rows: {writer.num_rows}", end="\r"
+                )
+    writer.close()
+
+    print(f"\nSaved {len(writer.dims)} fields to {out_path}/")
+    print(f"Episodes: {sum(map(len, writer.ep_lengths))} | Rows: {writer.num_rows}")
+
+
+if __name__ == "__main__":
+    main()
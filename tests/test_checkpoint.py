@@ -0,0 +1,32 @@
+import os
+
+import torch
+
+from locodiff import checkpoint
+
+
+def make_state():
+    return {"weight": torch.randn(4, 3), "steps": torch.tensor(7)}
+
+
+def test_half_without_ema(tmp_path):
+    path = os.path.join(tmp_path, checkpoint.CHECKPOINT_FILE)
+    scaler_state = {"x_max": torch.ones(3)}
+    checkpoint.save_checkpoint(path, None, make_state(), scaler_state, half=True)
+
+    state = checkpoint.load_checkpoint(path)
+    assert state["ema"]["weight"].dtype == torch.float16
+    assert state["ema"]["steps"].dtype == torch.int64
+    assert state["scaler"]["x_max"].dtype == torch.float32
+
+
+def test_half_with_ema(tmp_path):
+    path = os.path.join(tmp_path, checkpoint.CHECKPOINT_FILE)
+    scaler_state = {"x_max": torch.ones(3)}
+    checkpoint.save_checkpoint(
+        path, make_state(), make_state(), scaler_state, half=True
+    )
+
+    state = checkpoint.load_checkpoint(path)
+    assert state["ema"]["weight"].dtype == torch.float16
+    assert state["model"]["weight"].dtype == torch.float32
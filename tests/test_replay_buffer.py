@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from locodiff.replay_buffer import MixedLoader, ReplayBuffer
+
+
+def add_episode(buffer, length):
+    buffer.add_episode(
+        np.ones((length, 3)), np.ones((length, 2)), np.zeros(3), np.zeros(2)
+    )
+
+
+def test_sample_after_evicting_all_windows():
+    buffer = ReplayBuffer(capacity=10, T_cond=2, T=4)
+    add_episode(buffer, 10)
+    assert buffer.sample(4)["action"].shape == (4, 5, 2)
+
+    # too short for a window, and it evicts the only full episode
+    add_episode(buffer, 3)
+    assert len(buffer) == 0
+    assert buffer.sample(4) is None
+
+    # the expert batch is used as is
+    loader = MixedLoader(SimpleNamespace(batch_size=8), buffer, 0.5, None)
+    batch = {"action": torch.zeros(8, 5, 2)}
+    assert loader.mix(batch) is batch